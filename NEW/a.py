@@ -1,21 +1,197 @@
 import pandas as pd
+import numpy as np
 import time
 import os
 import sys
+import signal
+import asyncio
 from google import genai
+from google.genai import types
 from tqdm import tqdm
 from dotenv import load_dotenv
 from pathlib import Path
 import json
+import math
+import re
+import socket
+import threading
+from contextlib import contextmanager
+import hashlib
+import itertools
+import random
+import glob
+import sqlite3
+import queue
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+# Optional: only needed for Parquet output and Hugging Face datasets sources
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 # ----------------- LOAD ENV -----------------
 load_dotenv()
 
 API_KEYS = os.getenv("API_KEYS").split(",")
 BATCH_SIZE = 100
+MODEL_NAME = "gemini-2.5-flash"
+
+# Async execution mode: keep several requests in flight instead of one at a time
+ASYNC_MODE = os.getenv("ASYNC_MODE", "0") == "1"
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "0"))  # requests in flight across all keys (0: keys x per key)
+PER_KEY_CONCURRENCY = int(os.getenv("PER_KEY_CONCURRENCY", "2"))  # requests in flight per key
+
+# Adaptive (AIMD) concurrency: the in-flight window moves between the min and MAX_CONCURRENCY
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "1") == "1"
+ADAPTIVE_INITIAL_CONCURRENCY = int(os.getenv("ADAPTIVE_INITIAL_CONCURRENCY", "4"))
+ADAPTIVE_MIN_CONCURRENCY = int(os.getenv("ADAPTIVE_MIN_CONCURRENCY", "1"))
+ADAPTIVE_LATENCY_TOLERANCE = 1.5  # grow while recent latency is within this factor of the baseline
+ADAPTIVE_DECREASE_FACTOR = 0.5  # window multiplier on a 429/5xx
+
+# Request timeouts: once a task has enough latency samples its timeout is p95 x factor
+# (so long Complex_CoT prompts get a longer budget than short Question prompts)
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("REQUEST_TIMEOUT_SECONDS", "180"))  # until then
+REQUEST_TIMEOUT_FACTOR = float(os.getenv("REQUEST_TIMEOUT_FACTOR", "3"))
+REQUEST_TIMEOUT_MIN_SECONDS = 10
+REQUEST_TIMEOUT_MAX_SECONDS = float(os.getenv("REQUEST_TIMEOUT_MAX_SECONDS", "600"))  # also the HTTP timeout
+LATENCY_SAMPLES = 200  # recent successful latencies kept per task
+LATENCY_MIN_SAMPLES = 20
+
+# Hedging (async mode): a request slower than the task's p90 is duplicated on another key.
+# Off by default: the losing copy still counts against the key's daily quota.
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "0") == "1"
+HEDGE_PERCENTILE = 90
+
+# Timeouts, 5xx and other unexpected errors are retried with exponential backoff
+TRANSIENT_RETRIES = int(os.getenv("TRANSIENT_RETRIES", "4"))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+# Shared prompt prefix: each task's static instructions (its prompt template up to the last paragraph)
+# go out as system_instruction ("system"), through an explicit context cache per key and task ("cached";
+# needs a model and tier with context caching and instructions above its minimum token count, otherwise
+# "system" is used), or inline in one prompt with the input ("inline", as before)
+PROMPT_MODE = os.getenv("PROMPT_MODE", "system")
+PROMPT_CACHE_TTL_SECONDS = int(os.getenv("PROMPT_CACHE_TTL_SECONDS", "3600"))
+
+# Per-key quotas (free tier gemini-2.5-flash defaults) and key pool behaviour
+REQUESTS_PER_MINUTE_PER_KEY = int(os.getenv("REQUESTS_PER_MINUTE_PER_KEY", "10"))
+REQUESTS_PER_DAY_PER_KEY = int(os.getenv("REQUESTS_PER_DAY_PER_KEY", "250"))
+QUOTA_STATE_FILE = os.getenv("QUOTA_STATE_FILE", "key_quota_state.json")
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")  # daily quotas reset at midnight Pacific
+QUOTA_SAVE_EVERY = 10  # requests between quota state saves
+DEFAULT_COOLDOWN_SECONDS = 60  # cooldown after a 429 without RetryInfo
+MAX_KEY_WAIT_SECONDS = 15 * 60  # give up instead of waiting longer than this for a key
+
+# Persistent translation cache shared by every process using the same file
+USE_CACHE = os.getenv("USE_CACHE", "1") == "1"
+CACHE_FILE = os.getenv("CACHE_FILE", "translation_cache.sqlite3")
+CACHE_MAX_MB = float(os.getenv("CACHE_MAX_MB", "512"))
+CACHE_EVICT_EVERY = 100  # puts between size checks
+
+# Result journal: fsync after this many results or seconds, whichever comes first
+JOURNAL_FSYNC_EVERY = int(os.getenv("JOURNAL_FSYNC_EVERY", "20"))
+JOURNAL_FSYNC_SECONDS = float(os.getenv("JOURNAL_FSYNC_SECONDS", "5"))
+# Checkpoint writes (journal lines and fsyncs, quota state, streamed chunks) run on a background thread;
+# once this many are queued, new results wait for the disk to catch up
+CHECKPOINT_QUEUE_SIZE = int(os.getenv("CHECKPOINT_QUEUE_SIZE", "1000"))
+
+# Request packing: several short inputs of one task share a structured-output request
+PACK_REQUESTS = os.getenv("PACK_REQUESTS", "0") == "1"
+PACK_MAX_ITEMS = int(os.getenv("PACK_MAX_ITEMS", "20"))  # inputs per request at most
+PACK_MAX_CHARS = int(os.getenv("PACK_MAX_CHARS", "8000"))  # total input characters per request
+PACK_ITEM_MAX_CHARS = int(os.getenv("PACK_ITEM_MAX_CHARS", "1500"))  # longer inputs are sent alone
+PACKED_PROMPT_NOTE = """
+
+বিশেষ নির্দেশনা: উপরের ইনপুটটি একটি JSON তালিকা, যার প্রতিটি উপাদানে একটি "id" এবং একটি "text" আছে। প্রতিটি "text" আলাদাভাবে উপরের নির্দেশনা অনুযায়ী অনুবাদ করুন। একটি JSON তালিকা ফেরত দিন, যার প্রতিটি উপাদানে একই "id" এবং অনূদিত লেখাটি "translation" হিসেবে থাকবে। কোনো id বাদ দেবেন না।"""
+PACKED_RESPONSE_CONFIG = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema={
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {"id": {"type": "STRING"}, "translation": {"type": "STRING"}},
+            "required": ["id", "translation"],
+        },
+    },
+)
+
+# Long-form tasks ("long_form": True) split inputs longer than SEGMENT_MAX_CHARS at paragraph,
+# then sentence boundaries, and translate the segments as independent parallel requests
+SEGMENT_LONG_FORM = os.getenv("SEGMENT_LONG_FORM", "1") == "1"
+SEGMENT_MAX_CHARS = int(os.getenv("SEGMENT_MAX_CHARS", "2500"))
+SEGMENT_RETRIES = 2  # extra requests for a segment whose output fails verification
+SEGMENT_MIN_OUTPUT_RATIO = 0.3  # output shorter than this fraction of its input counts as truncated
+
+# Output validation: finished cells are checked column by column (Bangla script share, output/input
+# length ratio, echoed prompt or input, commentary around the translation) and failing cells are
+# translated again, at most VALIDATION_RETRIES times per cell (counted across runs in the journal).
+# Responses that stopped early (MAX_TOKENS, SAFETY, ...) are requested again up to the same cap
+VALIDATE_OUTPUTS = os.getenv("VALIDATE_OUTPUTS", "1") == "1"
+VALIDATION_RETRIES = int(os.getenv("VALIDATION_RETRIES", "2"))
+VALIDATION_MIN_BANGLA_RATIO = float(os.getenv("VALIDATION_MIN_BANGLA_RATIO", "0.5"))  # of Bangla + Latin letters
+VALIDATION_MIN_LENGTH_RATIO = 0.3  # output/input characters
+VALIDATION_MAX_LENGTH_RATIO = 4.0
+VALIDATION_MIN_INPUT_CHARS = 40  # shorter inputs skip the length ratio check
+VALIDATION_ECHO_CHARS = 60  # an output containing this much of the input's opening verbatim echoes it
+
+# Output format of the final files: "csv" (utf-8-sig) or "parquet" (needs pyarrow; loads with
+# datasets' Dataset.from_parquet without re-parsing CSV text)
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "csv")
+PARQUET_ROW_GROUP_ROWS = int(os.getenv("PARQUET_ROW_GROUP_ROWS", "1000"))
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd")
+
+# Hugging Face datasets sources (a save_to_disk directory, a cache directory of .arrow files, or
+# .arrow/.parquet files) are read batch by batch from their memory-mapped files. DATASET_COLUMNS
+# maps TASKS input columns to dataset columns, e.g. "Question=question,Complex_CoT=reasoning"
+DATASET_SPLIT = os.getenv("DATASET_SPLIT", "train")
+DATASET_COLUMNS = os.getenv("DATASET_COLUMNS", "")
+
+# Streaming mode: read, process and write the input in chunks instead of loading it whole
+STREAM_MODE = os.getenv("STREAM_MODE", "0") == "1"
+STREAM_CHUNK_ROWS = int(os.getenv("STREAM_CHUNK_ROWS", "500"))
+
+# Worker mode: several processes share one input file through leased row ranges
+LEASE_RANGE_ROWS = int(os.getenv("LEASE_RANGE_ROWS", str(BATCH_SIZE)))
+LEASE_SECONDS = float(os.getenv("LEASE_SECONDS", "300"))  # renewed every third of this
+
+# Multi-file async runs share one work queue; FILE_ORDER picks which file's work goes first:
+# "interleave" (round robin), "shortest" (fewest pending cells first) or "given" (argument order)
+FILE_ORDER = os.getenv("FILE_ORDER", "interleave")
+
+# Metrics: counters and latency histograms flushed every METRICS_FLUSH_SECONDS to a JSON
+# snapshot and a Prometheus text file, plus a JSONL event log (an empty name turns a file off)
+METRICS_FILE = os.getenv("METRICS_FILE", "metrics.json")
+METRICS_PROM_FILE = os.getenv("METRICS_PROM_FILE", "metrics.prom")
+METRICS_EVENTS_FILE = os.getenv("METRICS_EVENTS_FILE", "metrics_events.jsonl")
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "30"))
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)  # histogram upper bounds, seconds
+
+# Capacity planner (--plan): token counts are estimated from input lengths with these ratios, and
+# request latency comes from METRICS_FILE of an earlier run when it has enough samples. Prices are
+# USD per million tokens on the paid tier (0 hides the cost)
+PLAN_CHARS_PER_TOKEN = 4.0  # English input
+PLAN_BANGLA_CHARS_PER_TOKEN = 2.5  # Bangla instructions
+PLAN_OUTPUT_TOKEN_RATIO = float(os.getenv("PLAN_OUTPUT_TOKEN_RATIO", "2.0"))  # Bangla output tokens per input token
+PLAN_LATENCY_SECONDS = float(os.getenv("PLAN_LATENCY_SECONDS", "10"))  # assumed per request
+PLAN_PRICE_INPUT_PER_M = float(os.getenv("PLAN_PRICE_INPUT_PER_M", "0.30"))
+PLAN_PRICE_OUTPUT_PER_M = float(os.getenv("PLAN_PRICE_OUTPUT_PER_M", "2.50"))
+
+# Quiet mode: no per-request lines or progress bars, just a status line every flush
+QUIET = os.getenv("QUIET", "0") == "1"
+
+# Task config: BUILTIN_TASKS below cover medical-o1-reasoning-SFT; TASKS_FILE (or --tasks=FILE), when
+# present, adds a JSON list of tasks for other datasets (a task writing a built-in output column replaces
+# it). Each input only runs the tasks whose input column it has (directly or through another task's output);
+# tasks.example.json shows a task reading another task's output (python a.py --tasks=tasks.example.json ...)
+TASKS_FILE = os.getenv("TASKS_FILE", "tasks.json")
 
 # Tasks for medical-o1-reasoning-SFT dataset
-TASKS = [
+BUILTIN_TASKS = [
     {
         "input_column": "Question",
         "output_column": "Question_Bangla",
@@ -33,6 +209,7 @@ TASKS = [
     {
         "input_column": "Complex_CoT",
         "output_column": "Complex_CoT_Bangla", 
+        "long_form": True,
         "prompt_template": """আপনি একজন দক্ষ চিকিৎসা অনুবাদক। নিচে একটি ইংরেজি চিকিৎসা যুক্তিক্রম (reasoning process) দেওয়া হয়েছে। আপনার কাজ হলো এই পুরো যুক্তিক্রমটিকে সঠিক ও স্পষ্ট বাংলায় অনুবাদ করা।
 
 গুরুত্বপূর্ণ নির্দেশনা:
@@ -63,307 +240,3261 @@ TASKS = [
 ]
 
 
-# ----------------- PROGRESS MANAGER -----------------
+# ----------------- TASK CONFIG -----------------
+
+TASK_KEYS = {"input_column", "output_column", "prompt_template", "long_form", "model", "generation_config",
+             "weight", "validate", "min_length_ratio", "max_length_ratio", "min_bangla_ratio"}
+
+def prepare_tasks(tasks):
+    """Check a task list and return it ordered so every task follows the task whose output it reads.
+
+    Besides the required input_column, output_column and prompt_template, a task may set:
+    - model and generation_config (GenerateContentConfig fields, e.g. temperature)
+    - weight: its share of the in-flight window relative to the heaviest task (default 1)
+    - long_form, and validate / min_length_ratio / max_length_ratio / min_bangla_ratio
+    A task whose input_column is another task's output_column depends on it: a row's
+    cell starts once that row's input cell is done. Raises ValueError on a bad config.
+    """
+    by_output = {}
+    for task in tasks:
+        missing = {"input_column", "output_column", "prompt_template"} - set(task)
+        if missing:
+            raise ValueError(f"task {task.get('output_column', '?')} is missing {', '.join(sorted(missing))}")
+        unknown = set(task) - TASK_KEYS
+        if unknown:
+            raise ValueError(f"task {task['output_column']} has unknown keys: {', '.join(sorted(unknown))}")
+        if "{}" not in task["prompt_template"]:
+            raise ValueError(f"task {task['output_column']}: prompt_template needs a {{}} for the input")
+        if task["output_column"] in by_output:
+            raise ValueError(f"two tasks write {task['output_column']}")
+        by_output[task["output_column"]] = task
+
+    ordered = []
+    visiting = set()
+
+    def visit(task):
+        if task in ordered:
+            return
+        if task["output_column"] in visiting:
+            raise ValueError(f"tasks depend on each other in a cycle through {task['output_column']}")
+        visiting.add(task["output_column"])
+        upstream = by_output.get(task["input_column"])
+        if upstream is not None:
+            visit(upstream)
+        visiting.discard(task["output_column"])
+        ordered.append(task)
+
+    for task in tasks:
+        visit(task)
+
+    prepared = []
+    for task in ordered:
+        task = dict(task)
+        config = task.get("generation_config")
+        task["config"] = types.GenerateContentConfig(**config) if config else None
+        task["model"] = task.get("model") or MODEL_NAME
+        task["weight"] = float(task.get("weight", 1))
+        upstream = by_output.get(task["input_column"])
+        task["upstream"] = ordered.index(upstream) if upstream is not None else None
+        prepared.append(task)
+    for index, task in enumerate(prepared):
+        task["dependents"] = [i for i, other in enumerate(prepared) if other["upstream"] == index]
+    return prepared
+
+def load_tasks(path):
+    """Load the tasks of a JSON file and prepare them together with the built-in tasks."""
+    with open(path, 'r', encoding='utf-8') as f:
+        tasks = json.load(f)
+    if not isinstance(tasks, list):
+        raise ValueError("the file must hold a JSON list of tasks")
+    overridden = {task.get("output_column") for task in tasks}
+    return prepare_tasks([task for task in BUILTIN_TASKS if task["output_column"] not in overridden] + tasks)
+
+def root_input_column(task):
+    """The input column a task ultimately reads, following dependencies back to the source data."""
+    while task["upstream"] is not None:
+        task = TASKS[task["upstream"]]
+    return task["input_column"]
+
+def task_indices(df):
+    """Positions of the TASKS that apply to df (their input and output columns are present)."""
+    return [i for i, task in enumerate(TASKS)
+            if task["output_column"] in df.columns and task["input_column"] in df.columns]
+
+TASKS = prepare_tasks(BUILTIN_TASKS)
+
+
+# ----------------- METRICS -----------------
+
+class Metrics:
+    """Process-wide counters, gauges and latency histograms with a JSONL event log.
+
+    Series are keyed by name and labels (key, task, outcome, ...). Once started, a
+    background thread writes a JSON snapshot and a Prometheus text file every
+    flush_seconds; in quiet mode it also prints a one-line status, replacing the
+    per-request prints and progress bars.
+    """
+
+    def __init__(self, json_file=METRICS_FILE, prom_file=METRICS_PROM_FILE, events_file=METRICS_EVENTS_FILE,
+                 flush_seconds=METRICS_FLUSH_SECONDS, quiet=QUIET):
+        self.json_file = json_file
+        self.prom_file = prom_file
+        self.events_file = events_file
+        self.flush_seconds = flush_seconds
+        self.quiet = quiet
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.events = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @staticmethod
+    def _series(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        series = self._series(name, labels)
+        with self.lock:
+            self.counters[series] = self.counters.get(series, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._series(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        series = self._series(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(series)
+            if histogram is None:
+                histogram = self.histograms[series] = {"buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+                                                       "sum": 0.0, "count": 0}
+            bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if value <= bound), len(LATENCY_BUCKETS))
+            histogram["buckets"][bucket] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """Add the seconds spent in the block to counter name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inc(name, time.perf_counter() - start, **labels)
+
+    def record_request(self, key, task, outcome, latency=None, response=None):
+        """Count one API request; successful ones also feed the latency histograms and token counters."""
+        self.inc("requests_total", key=key, task=task, outcome=outcome)
+        if latency is not None:
+            self.observe("request_latency_seconds", latency, task=task)
+            self.observe("key_latency_seconds", latency, key=key)
+            self.inc("network_seconds_total", latency, task=task)
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            self.inc("tokens_total", usage.prompt_token_count or 0, task=task, direction="input")
+            self.inc("tokens_total", usage.candidates_token_count or 0, task=task, direction="output")
+            self.inc("tokens_total", usage.cached_content_token_count or 0, task=task, direction="cached")
+
+    def event(self, kind, **fields):
+        """Append one structured event to the event log (when started)."""
+        if self.events is None:
+            return
+        line = json.dumps({"ts": round(time.time(), 3), "event": kind, **fields}, ensure_ascii=False, default=str)
+        with self.lock:
+            self.events.write(line + "\n")
+
+    def log(self, message, kind=None, **fields):
+        """Print a per-request message unless quiet; kind also records it as an event."""
+        if kind is not None:
+            self.event(kind, **fields)
+        if not self.quiet:
+            print(message)
+
+    # ----- output -----
+
+    def total(self, name, **labels):
+        """Sum of a counter over every series whose labels include the given ones."""
+        wanted = {(key, str(value)) for key, value in labels.items()}
+        with self.lock:
+            return sum(value for (series_name, series_labels), value in self.counters.items()
+                       if series_name == name and wanted <= set(series_labels))
 
-class ProgressManager:
-    def __init__(self, csv_filename):
-        # Create progress file name based on CSV filename
+    def snapshot(self):
+        with self.lock:
+            return {
+                "timestamp": time.time(),
+                "uptime_seconds": round(time.time() - self.started, 3),
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value}
+                           for (name, labels), value in sorted(self.gauges.items())],
+                "histograms": [{"name": name, "labels": dict(labels), "buckets": list(LATENCY_BUCKETS),
+                                "counts": list(h["buckets"]), "sum": h["sum"], "count": h["count"]}
+                               for (name, labels), h in sorted(self.histograms.items())],
+            }
+
+    def prometheus_text(self):
+        def label_text(labels, extra=()):
+            pairs = [f'{key}="{value}"' for key, value in (*labels, *extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        with self.lock:
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in series}):
+                    lines.append(f"# TYPE translator_{name} {kind}")
+                    for (series_name, labels), value in sorted(series.items()):
+                        if series_name == name:
+                            lines.append(f"translator_{name}{label_text(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE translator_{name} histogram")
+                for (series_name, labels), h in sorted(self.histograms.items()):
+                    if series_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip((*LATENCY_BUCKETS, "+Inf"), h["buckets"]):
+                        cumulative += count
+                        lines.append(f"translator_{name}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"translator_{name}_sum{label_text(labels)} {h['sum']}")
+                    lines.append(f"translator_{name}_count{label_text(labels)} {h['count']}")
+        return "\n".join(lines) + "\n"
+
+    def status_line(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        cells = self.total("cells_total", status="ok")
+        return (f"📊 {cells:,} cells ({cells / elapsed:.2f}/s) | {self.total('requests_total'):,} requests, "
+                f"{self.total('requests_total', outcome='rate_limited'):,} rate limited | "
+                f"tokens {self.total('tokens_total', direction='input'):,} in / "
+                f"{self.total('tokens_total', direction='output'):,} out | "
+                f"network {self.total('network_seconds_total'):.0f}s, "
+                f"checkpoint {self.total('checkpoint_seconds_total'):.1f}s")
+
+    def flush(self):
+        """Write the JSON snapshot and the Prometheus file (tmp + rename) and flush the event log."""
+        for path, content in ((self.json_file, lambda: json.dumps(self.snapshot(), indent=1)),
+                              (self.prom_file, self.prometheus_text)):
+            if not path:
+                continue
+            tmp_file = temp_file(path)
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(content())
+            os.replace(tmp_file, path)
+        if self.events is not None:
+            with self.lock:
+                self.events.flush()
+
+    def start(self):
+        if self.events_file and self.events is None:
+            self.events = open(self.events_file, 'a', encoding='utf-8')
+        self.event("run_started", pid=os.getpid())
+
+        def flush_loop():
+            while not self._stop.wait(self.flush_seconds):
+                try:
+                    self.flush()
+                    if self.quiet:
+                        print(self.status_line(), flush=True)
+                except Exception as e:
+                    print(f"⚠️ Could not write metrics: {e}")
+
+        self._thread = threading.Thread(target=flush_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.event("run_finished", uptime_seconds=round(time.time() - self.started, 3))
+        self.flush()
+        if self.events is not None:
+            self.events.close()
+            self.events = None
+
+metrics = Metrics()
+
+def progress_bar(**kwargs):
+    """A tqdm bar, disabled in quiet mode (the metrics status line reports progress instead)."""
+    if metrics.quiet:
+        kwargs["disable"] = True
+    return tqdm(**kwargs)
+
+
+# ----------------- CHECKPOINT WRITER -----------------
+
+def temp_file(path):
+    """Temporary file next to path, named for this process and thread so concurrent writers never share one."""
+    path = Path(path)
+    return path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+
+def atomic_replace(tmp_file, path):
+    """Rename a fully written tmp_file over path once its data is on disk.
+
+    path then holds either the old or the new complete file after any crash or power
+    loss; the directory is fsynced too so the rename itself is not lost. tmp_file must
+    exist: it is opened without being created.
+    """
+    with open(tmp_file, 'r+b') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+    try:
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return  # directories cannot be opened on Windows, where the rename is journaled anyway
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+def write_json_atomic(path, data):
+    tmp_file = temp_file(path)
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    atomic_replace(tmp_file, path)
+
+class CheckpointWriter:
+    """Background thread doing the checkpoint disk I/O, in submission order.
+
+    submit() queues a write and returns, so requests never wait on the disk. The queue
+    is bounded: once the disk is max_queue writes behind, submit() blocks until there
+    is room (backpressure), slowing new results instead of piling them up in memory.
+    flush() waits for everything submitted before it. A failed write is raised from
+    the next submit() or flush().
+    """
+
+    def __init__(self, max_queue=CHECKPOINT_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.error = None
+        self._thread = None
+
+    def _run(self):
+        while True:
+            func, args = self.queue.get()
+            try:
+                func(*args)
+            except Exception as e:
+                self.error = self.error or e
+                metrics.log(f"❌ Checkpoint write failed: {e}", "checkpoint_failed", error=str(e))
+            finally:
+                self.queue.task_done()
+                metrics.set("checkpoint_queue_depth", self.queue.qsize())
+
+    def _raise_error(self):
+        error, self.error = self.error, None
+        if error is not None:
+            raise RuntimeError(f"checkpoint write failed: {error}") from error
+
+    def submit(self, func, *args):
+        self._raise_error()
+        with self.lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+                self._thread.start()
+        try:
+            self.queue.put_nowait((func, args))
+        except queue.Full:
+            metrics.inc("checkpoint_backpressure_total")
+            with metrics.timed("checkpoint_wait_seconds_total", op="backpressure"):
+                self.queue.put((func, args))
+        metrics.set("checkpoint_queue_depth", self.queue.qsize())
+
+    def flush(self):
+        if self._thread is not None:
+            # Writes run in order, so once this marker runs everything before it is done
+            done = threading.Event()
+            self.submit(done.set)
+            with metrics.timed("checkpoint_wait_seconds_total", op="flush"):
+                done.wait()
+        self._raise_error()
+
+checkpoints = CheckpointWriter()
+
+
+# ----------------- RESULT JOURNAL -----------------
+
+class ResultJournal:
+    """Append-only JSONL journal of completed (row, output column) cells for one CSV.
+
+    Each result costs one appended line, no matter how large the file is. The journal
+    is fsynced every fsync_every entries or fsync_seconds, and replaying it on top of
+    the input CSV restores every result from earlier runs. Outputs rejected by
+    validation are journaled as a null output with the failed checks, which clears
+    the cell on replay and counts towards its VALIDATION_RETRIES in self.rejections.
+    Appends and fsyncs run on the checkpoints writer thread; sync() and close() wait
+    until everything recorded so far is on disk.
+    """
+
+    def __init__(self, csv_filename, worker_id=None, fsync_every=JOURNAL_FSYNC_EVERY,
+                 fsync_seconds=JOURNAL_FSYNC_SECONDS):
         csv_stem = Path(csv_filename).stem
-        self.progress_file = f"{csv_stem}_processing_progress.json"
-        self.progress_data = self.load_progress()
+        # Workers sharing one input each append to their own journal
+        suffix = f".{worker_id}" if worker_id else ""
+        self.journal_file = f"{csv_stem}_results{suffix}.jsonl"
+        self.fsync_every = fsync_every
+        self.fsync_seconds = fsync_seconds
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.rejections = Counter()  # (row, column) -> outputs rejected so far
+
+    def entries(self):
+        """Yield every journaled entry in the order it was written."""
+        if not os.path.exists(self.journal_file):
+            return
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn last line from a crash mid-write; everything before it is intact
+                    print(f"⚠️ Skipping unreadable journal line {line_number} in {self.journal_file}")
+
+    def replay(self, df, rows=None):
+        """Apply every journaled result (of the given rows only, if given) to df. Returns the number of cells restored."""
+        restored = 0
+        for entry in self.entries():
+            if rows is not None and entry["row"] not in rows:
+                continue
+            if entry["column"] in df.columns and entry["row"] < len(df):
+                df.at[entry["row"], entry["column"]] = entry["output"]
+                if entry.get("rejected"):
+                    self.rejections[(entry["row"], entry["column"])] += 1
+                else:
+                    restored += 1
+        return restored
+
+    def load_results(self, min_row=0):
+        """Return {(row, column): output} for journaled rows at or after min_row."""
+        results = {}
+        for entry in self.entries():
+            if entry["row"] >= min_row:
+                results[(entry["row"], entry["column"])] = entry["output"]
+                if entry.get("rejected"):
+                    self.rejections[(entry["row"], entry["column"])] += 1
+        return results
 
-    def load_progress(self):
+    def open(self):
+        if self.file is None:
+            self._end_last_line()
+            self.file = open(self.journal_file, 'a', encoding='utf-8')
+            self.last_sync = time.time()
+
+    def _end_last_line(self):
+        """Make sure the next append starts a line of its own after a crash mid-write.
+
+        A last line without its newline is cut off, unless it is a complete entry
+        (the crash came just before the newline), which only gets the newline.
+        """
         try:
-            if os.path.exists(self.progress_file):
-                with open(self.progress_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            return {"current_batch": 0, "completed_rows": 0, "total_rows": 0}
-        except Exception as e:
-            print(f"Error loading progress from {self.progress_file}: {e}")
-            return {"current_batch": 0, "completed_rows": 0, "total_rows": 0}
-
-    def save_progress(self, current_batch, completed_rows, total_rows):
-        self.progress_data = {
-            "current_batch": current_batch,
-            "completed_rows": completed_rows,
-            "total_rows": total_rows
-        }
+            f = open(self.journal_file, 'r+b')
+        except FileNotFoundError:
+            return
+        with f:
+            size = f.seek(0, os.SEEK_END)
+            end = size
+            tail = b""
+            while end > 0:
+                start = max(0, end - 65536)
+                f.seek(start)
+                tail = f.read(end - start) + tail
+                if b"\n" in tail:
+                    break
+                end = start
+            tail = tail[tail.rfind(b"\n") + 1:]
+            if not tail:
+                return
+            try:
+                json.loads(tail)
+                f.seek(0, os.SEEK_END)
+                f.write(b"\n")
+            except ValueError:
+                f.truncate(size - len(tail))
+                print(f"✂️ Dropping an unfinished last line from {self.journal_file}")
+
+    def _append(self, line):
+        """Runs on the writer thread."""
+        self.open()
+        with metrics.timed("checkpoint_seconds_total", op="journal_write"):
+            self.file.write(line)
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_every or time.time() - self.last_sync >= self.fsync_seconds:
+            self._fsync()
+
+    def _fsync(self):
+        """Runs on the writer thread."""
+        if self.file is None:
+            return
+        with metrics.timed("checkpoint_seconds_total", op="journal_fsync"):
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def _close(self):
+        """Runs on the writer thread."""
+        if self.file is not None:
+            self._fsync()
+            self.file.close()
+            self.file = None
+
+    def record(self, row, column, output):
+        line = json.dumps({"row": int(row), "column": column, "output": output}, ensure_ascii=False) + "\n"
+        checkpoints.submit(self._append, line)
+
+    def reject(self, row, column, reasons):
+        """Journal that a cell's output failed validation; replay clears the cell."""
+        line = json.dumps({"row": int(row), "column": column, "output": None, "rejected": reasons},
+                          ensure_ascii=False) + "\n"
+        self.rejections[(int(row), column)] += 1
+        checkpoints.submit(self._append, line)
+
+    def sync(self):
+        """Wait until every result recorded so far is fsynced."""
+        checkpoints.submit(self._fsync)
+        checkpoints.flush()
+
+    def close(self):
+        checkpoints.submit(self._close)
+        checkpoints.flush()
+
+    @staticmethod
+    def journal_files(csv_filename):
+        """The main journal plus every worker journal of one CSV."""
+        csv_stem = Path(csv_filename).stem
+        return sorted(glob.glob(f"{glob.escape(csv_stem)}_results*.jsonl"))
+
+
+def replay_journals(csv_filename, df, rejections=None, rows=None):
+    """Replay the main and all worker journals of a CSV (for the given rows only, if given) onto df.
+
+    Returns cells restored. Rejected outputs found on the way are added to the
+    rejections Counter, if given.
+    """
+    restored = 0
+    for journal_file in ResultJournal.journal_files(csv_filename):
+        journal = ResultJournal(csv_filename)
+        journal.journal_file = journal_file
+        restored += journal.replay(df, rows)
+        if rejections is not None:
+            rejections.update(journal.rejections)
+    return restored
+
+
+# ----------------- WORKER LEASES -----------------
+
+class LeaseCoordinator:
+    """Hands out row ranges of one input file to several worker processes.
+
+    Ranges live in a shared SQLite file. A worker claims a range with a lease that it
+    renews while working; a lease that is not renewed (crashed worker) expires and
+    the range is claimed again by whoever asks next.
+    """
+
+    def __init__(self, file_path, worker_id, total_rows, range_rows=LEASE_RANGE_ROWS,
+                 lease_seconds=LEASE_SECONDS):
+        self.lease_file = f"{Path(file_path).stem}_leases.sqlite3"
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.conn = self._connect()
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS ranges (
+                    start INTEGER PRIMARY KEY,
+                    end INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    expires_at REAL NOT NULL DEFAULT 0
+                )
+            """)
+            # INSERT OR IGNORE makes it safe for every worker to try to create the ranges
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO ranges (start, end) VALUES (?, ?)",
+                [(start, min(start + range_rows, total_rows)) for start in range(0, total_rows, range_rows)]
+            )
+
+    def _connect(self):
+        conn = sqlite3.connect(self.lease_file, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def claim(self):
+        """Lease the first pending or expired range.
+
+        Returns (start, end, reclaimed), reclaimed being True for a range taken over from
+        another worker's expired lease, or None when no range is free.
+        """
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
         try:
-            with open(self.progress_file, 'w', encoding='utf-8') as f:
-                json.dump(self.progress_data, f, ensure_ascii=False, indent=2)
+            row = self.conn.execute("""
+                SELECT start, end, worker FROM ranges
+                WHERE status = 'pending' OR (status = 'leased' AND expires_at < ?)
+                ORDER BY start LIMIT 1
+            """, (now,)).fetchone()
+            if row is None:
+                self.conn.execute("COMMIT")
+                return None
+            start, end, previous_worker = row
+            self.conn.execute(
+                "UPDATE ranges SET status = 'leased', worker = ?, expires_at = ? WHERE start = ?",
+                (self.worker_id, now + self.lease_seconds, start)
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        reclaimed = bool(previous_worker) and previous_worker != self.worker_id
+        if reclaimed:
+            print(f"♻️ Reclaimed expired lease on rows {start + 1}-{end} from {previous_worker}")
+        return start, end, reclaimed
+
+    def _renew(self, conn, start):
+        cursor = conn.execute(
+            "UPDATE ranges SET expires_at = ? WHERE start = ? AND worker = ? AND status = 'leased'",
+            (time.time() + self.lease_seconds, start, self.worker_id)
+        )
+        return cursor.rowcount == 1
+
+    @contextmanager
+    def renewing(self, start):
+        """Keep the lease on a range alive from a background thread while the body runs."""
+        stop = threading.Event()
+
+        def renew_loop():
+            conn = self._connect()
+            try:
+                while not stop.wait(self.lease_seconds / 3):
+                    if not self._renew(conn, start):
+                        print(f"⚠️ Lost the lease on rows starting at {start + 1}; results are still journaled")
+                        break
+            finally:
+                conn.close()
+
+        thread = threading.Thread(target=renew_loop, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, start):
+        self.conn.execute(
+            "UPDATE ranges SET status = 'done', expires_at = 0 WHERE start = ? AND worker = ?",
+            (start, self.worker_id)
+        )
+
+    def release(self, start):
+        """Give an unfinished range back so another worker can take it right away."""
+        self.conn.execute(
+            "UPDATE ranges SET status = 'pending', worker = NULL, expires_at = 0 WHERE start = ? AND worker = ?",
+            (start, self.worker_id)
+        )
+
+    def all_done(self):
+        return self.conn.execute("SELECT COUNT(*) FROM ranges WHERE status != 'done'").fetchone()[0] == 0
+
+    def next_expiry(self):
+        """Earliest expiry among ranges leased by other workers, or None when none is leased."""
+        return self.conn.execute(
+            "SELECT MIN(expires_at) FROM ranges WHERE status = 'leased'"
+        ).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+# ----------------- KEY POOL SCHEDULER -----------------
+
+def parse_rate_limit_error(error):
+    """Extract (retry_delay_seconds, is_daily_quota) from a 429 RESOURCE_EXHAUSTED error.
+
+    The error body carries a google.rpc.RetryInfo detail (e.g. retryDelay "44s") and a
+    QuotaFailure detail naming the violated quota (e.g. GenerateRequestsPerDayPerProjectPerModel).
+    """
+    retry_delay = None
+    is_daily = False
+    details = getattr(error, "details", None)
+    if not isinstance(details, dict):
+        return retry_delay, is_daily
+
+    for detail in details.get("error", {}).get("details", []) or []:
+        detail_type = detail.get("@type", "")
+        if detail_type.endswith("google.rpc.RetryInfo"):
+            delay = str(detail.get("retryDelay", "")).rstrip("s")
+            try:
+                retry_delay = float(delay)
+            except ValueError:
+                pass
+        elif detail_type.endswith("google.rpc.QuotaFailure"):
+            for violation in detail.get("violations", []):
+                if "PerDay" in violation.get("quotaId", ""):
+                    is_daily = True
+    return retry_delay, is_daily
+
+
+def is_rate_limit_error(error):
+    return getattr(error, "code", None) == 429 or getattr(error, "status", None) == "RESOURCE_EXHAUSTED"
+
+def is_key_error(error):
+    """True for client errors that mean the key itself is unusable (invalid, revoked or not permitted).
+
+    Other client errors (400 for a bad or oversized input, 404 for an unknown model) would
+    fail the same way on every key, so they fail the request and leave the key in rotation.
+    """
+    return (getattr(error, "code", None) in (401, 403)
+            or getattr(error, "status", None) in ("UNAUTHENTICATED", "PERMISSION_DENIED")
+            or "API_KEY_INVALID" in str(error))
+
+
+class KeyPoolScheduler:
+    """Tracks per-key quota usage and hands out the key with the most headroom.
+
+    Keys that hit a rate limit are put in a cooldown (from RetryInfo) instead of being
+    banned, and keys that used up their daily quota rest until the quota resets.
+    Daily counts and cooldowns are saved to disk so a restart on the same day picks
+    up where the last run left off.
+    """
+
+    def __init__(self, api_keys, key_names, rpm_limit=REQUESTS_PER_MINUTE_PER_KEY,
+                 rpd_limit=REQUESTS_PER_DAY_PER_KEY, state_file=QUOTA_STATE_FILE):
+        self.key_names = key_names
+        # Identify keys by a hash so the state file never contains the keys themselves
+        self.key_ids = [hashlib.sha256(key.strip().encode()).hexdigest()[:16] for key in api_keys]
+        self.rpm_limit = rpm_limit
+        self.rpd_limit = rpd_limit
+        self.state_file = state_file
+        self.day = self._quota_day()
+        self.minute_window = [deque() for _ in api_keys]
+        self.requests_today = [0] * len(api_keys)
+        self.cooldown_until = [0.0] * len(api_keys)
+        self._unsaved_requests = 0
+        self._save_queued = False
+        self.load_state()
+
+    @staticmethod
+    def _quota_day():
+        # Gemini API daily quotas reset at midnight Pacific time
+        return datetime.now(QUOTA_TIMEZONE).date().isoformat()
+
+    @staticmethod
+    def _seconds_until_reset():
+        now = datetime.now(QUOTA_TIMEZONE)
+        tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), QUOTA_TIMEZONE)
+        return (tomorrow - now).total_seconds()
+
+    def _roll_day(self):
+        day = self._quota_day()
+        if day != self.day:
+            self.day = day
+            self.requests_today = [0] * len(self.key_ids)
+
+    def _prune(self, index, now):
+        window = self.minute_window[index]
+        while window and now - window[0] >= 60:
+            window.popleft()
+
+    def headroom(self, index, now=None):
+        """Requests this key can still make right now (min of minute and day budgets)."""
+        now = time.time() if now is None else now
+        self._roll_day()
+        self._prune(index, now)
+        if self.cooldown_until[index] > now:
+            return 0
+        minute_left = self.rpm_limit - len(self.minute_window[index])
+        day_left = self.rpd_limit - self.requests_today[index]
+        return max(0, min(minute_left, day_left))
+
+    def pick_key(self, exclude=()):
+        """Return the usable key index with the most headroom, or None."""
+        now = time.time()
+        best, best_headroom = None, 0
+        for index in range(len(self.key_ids)):
+            if index in exclude:
+                continue
+            room = self.headroom(index, now)
+            if room > best_headroom:
+                best, best_headroom = index, room
+        return best
+
+    def seconds_until_available(self, exclude=()):
+        """How long until some non-excluded key has headroom again (None if no keys left)."""
+        now = time.time()
+        waits = []
+        for index in range(len(self.key_ids)):
+            if index in exclude:
+                continue
+            if self.requests_today[index] >= self.rpd_limit:
+                waits.append(self._seconds_until_reset())
+                continue
+            wait = max(0.0, self.cooldown_until[index] - now)
+            self._prune(index, now)
+            if len(self.minute_window[index]) >= self.rpm_limit:
+                wait = max(wait, 60 - (now - self.minute_window[index][0]))
+            waits.append(wait)
+        return min(waits) if waits else None
+
+    def record_request(self, index):
+        self._roll_day()
+        self.minute_window[index].append(time.time())
+        self.requests_today[index] += 1
+        self._unsaved_requests += 1
+        if self._unsaved_requests >= QUOTA_SAVE_EVERY:
+            self.save_state(wait=False)
+
+    def report_rate_limit(self, index, error):
+        """Put a key in cooldown after a 429, using the server's RetryInfo when present."""
+        retry_delay, is_daily = parse_rate_limit_error(error)
+        if is_daily:
+            self.requests_today[index] = max(self.requests_today[index], self.rpd_limit)
+            self.cooldown_until[index] = time.time() + self._seconds_until_reset()
+            metrics.log(f"🌙 {self.key_names[index]} used up its daily quota, resting until reset",
+                        "daily_quota_exhausted", key=self.key_names[index])
+        else:
+            delay = retry_delay if retry_delay is not None else DEFAULT_COOLDOWN_SECONDS
+            self.cooldown_until[index] = max(self.cooldown_until[index], time.time() + delay)
+            metrics.log(f"⏳ {self.key_names[index]} rate limited, cooling down for {delay:.0f}s",
+                        "rate_limited", key=self.key_names[index], cooldown_seconds=delay)
+        self.save_state(wait=False)
+
+    def status(self, index):
+        now = time.time()
+        if self.requests_today[index] >= self.rpd_limit:
+            return "🌙 Daily quota used"
+        if self.cooldown_until[index] > now:
+            return f"⏳ Cooling down ({self.cooldown_until[index] - now:.0f}s)"
+        return "✅ Active"
+
+    def load_state(self):
+        try:
+            if os.path.exists(self.state_file):
+                with open(self.state_file, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                if state.get("day") == self.day:
+                    keys = state.get("keys", {})
+                    for index, key_id in enumerate(self.key_ids):
+                        saved = keys.get(key_id, {})
+                        self.requests_today[index] = saved.get("requests_today", 0)
+                        self.cooldown_until[index] = saved.get("cooldown_until", 0.0)
         except Exception as e:
-            print(f"Error saving progress to {self.progress_file}: {e}")
+            print(f"Error loading quota state from {self.state_file}: {e}")
 
-    def get_resume_point(self):
-        return self.progress_data["current_batch"], self.progress_data["completed_rows"]
+    def save_state(self, wait=True):
+        """Merge this process's counts into the shared state file and write it atomically.
 
-    def cleanup(self):
+        With wait=False (on the request path) the write is left to the checkpoint
+        writer, and a save already waiting there covers this one.
+        """
+        self._unsaved_requests = 0
+        if not wait:
+            if not self._save_queued:
+                self._save_queued = True
+                checkpoints.submit(self._save_queued_state)
+            return
+        checkpoints.flush()
+        self._save_queued_state()
+
+    def _save_queued_state(self):
+        self._save_queued = False
         try:
-            if os.path.exists(self.progress_file):
-                os.remove(self.progress_file)
-                print(f"🧹 Progress file {self.progress_file} cleaned up.")
+            with metrics.timed("checkpoint_seconds_total", op="quota_state"):
+                self._write_state()
         except Exception as e:
-            print(f"Error cleaning up progress file {self.progress_file}: {e}")
+            print(f"Error saving quota state to {self.state_file}: {e}")
+
+    def _write_state(self):
+        state = {"day": self.day, "keys": {}}
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                on_disk = json.load(f)
+        except (OSError, ValueError):
+            on_disk = {}  # missing or unreadable: this process's counts start the file again
+        if isinstance(on_disk, dict) and on_disk.get("day") == self.day:
+            state["keys"] = on_disk.get("keys", {})
+
+        for index, key_id in enumerate(self.key_ids):
+            saved = state["keys"].get(key_id, {})
+            state["keys"][key_id] = {
+                "requests_today": max(saved.get("requests_today", 0), self.requests_today[index]),
+                "cooldown_until": max(saved.get("cooldown_until", 0.0), self.cooldown_until[index]),
+            }
+
+        write_json_atomic(self.state_file, state)
+
+
+# ----------------- ADAPTIVE CONCURRENCY -----------------
+
+class AdaptiveConcurrencyController:
+    """AIMD window for the number of requests in flight.
+
+    The window grows by one after each full window of successes while latency stays
+    near its long-run baseline, and is cut multiplicatively on a 429 or 5xx (at most
+    once per typical request latency, so one burst counts once). Every change is
+    recorded with its reason.
+    """
+
+    def __init__(self, max_limit, min_limit=ADAPTIVE_MIN_CONCURRENCY, initial=ADAPTIVE_INITIAL_CONCURRENCY):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = float(max(self.min_limit, min(initial, max_limit)))
+        self.in_flight = 0
+        self.baseline_latency = None  # slow moving average of successful request latency
+        self.recent_latency = None  # fast moving average
+        self.successes_since_change = 0
+        self.last_decrease = 0.0
+        self.increases = 0
+        self.decreases = 0
+        self.changes = deque(maxlen=20)  # (timestamp, old window, new window, reason)
+        self._condition = None
+        self._loop = None
+
+    @property
+    def window(self):
+        return max(self.min_limit, int(self.limit))
+
+    def _ensure_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+            self.in_flight = 0
+
+    async def acquire(self):
+        self._ensure_loop()
+        with metrics.timed("wait_seconds_total", stage="window"):
+            async with self._condition:
+                while self.in_flight >= self.window:
+                    await self._condition.wait()
+                self.in_flight += 1
+
+    async def release(self, outcome, latency):
+        """Free a slot and adapt the window.
+
+        outcome is "ok", "rate_limited", "server_error", "timeout" or "error".
+        """
+        async with self._condition:
+            self.in_flight -= 1
+            self._observe(outcome, latency)
+            self._condition.notify_all()
+
+    def _observe(self, outcome, latency):
+        if outcome == "ok":
+            if self.recent_latency is None:
+                self.recent_latency = self.baseline_latency = latency
+            else:
+                self.recent_latency = 0.3 * latency + 0.7 * self.recent_latency
+                self.baseline_latency = 0.02 * latency + 0.98 * self.baseline_latency
+
+            self.successes_since_change += 1
+            if self.successes_since_change < self.window:
+                return
+            if self.recent_latency <= self.baseline_latency * ADAPTIVE_LATENCY_TOLERANCE:
+                if self.limit < self.max_limit:
+                    self._change(min(self.max_limit, self.limit + 1),
+                                 f"latency stable at {self.recent_latency:.1f}s")
+                    self.increases += 1
+            elif self.recent_latency > self.baseline_latency * 2 * ADAPTIVE_LATENCY_TOLERANCE:
+                self._change(max(self.min_limit, self.limit * 0.9),
+                             f"latency rising ({self.recent_latency:.1f}s vs {self.baseline_latency:.1f}s)")
+                self.decreases += 1
+            self.successes_since_change = 0
+
+        elif outcome in ("rate_limited", "server_error", "timeout"):
+            now = time.time()
+            # One burst of errors from the same window counts as a single congestion signal
+            if now - self.last_decrease < (self.recent_latency or 1.0):
+                return
+            self.last_decrease = now
+            reason = {"rate_limited": "429 rate limit", "server_error": "5xx server error",
+                      "timeout": "request timeout"}[outcome]
+            self._change(max(self.min_limit, self.limit * ADAPTIVE_DECREASE_FACTOR), reason)
+            self.decreases += 1
+            self.successes_since_change = 0
+
+    def _change(self, new_limit, reason):
+        old_window = self.window
+        self.limit = new_limit
+        if self.window != old_window:
+            self.changes.append((time.time(), old_window, self.window, reason))
+            arrow = "📈" if self.window > old_window else "📉"
+            metrics.set("concurrency_window", self.window)
+            metrics.log(f"{arrow} Concurrency window {old_window} → {self.window} ({reason})",
+                        "window_changed", old=old_window, new=self.window, reason=reason)
+
+    def print_stats(self):
+        latency = f"{self.recent_latency:.1f}s" if self.recent_latency is not None else "n/a"
+        print(f"🎚️ Concurrency window: {self.window} (range {self.min_limit}-{self.max_limit}) | "
+              f"{self.increases} increases / {self.decreases} decreases | recent latency {latency}")
+        for timestamp, old, new, reason in list(self.changes)[-5:]:
+            print(f"   {datetime.fromtimestamp(timestamp):%H:%M:%S} {old} → {new}: {reason}")
+
+
+# ----------------- REQUEST TIMEOUTS -----------------
+
+class LatencyTracker:
+    """Recent successful request latencies per budget, used to size timeouts and hedges.
+
+    Each task has its own budget, so a slow Complex_CoT request is not judged by
+    Question latencies. Until a budget has LATENCY_MIN_SAMPLES samples it uses
+    REQUEST_TIMEOUT_SECONDS and is never hedged.
+    """
+
+    def __init__(self, samples=LATENCY_SAMPLES, min_samples=LATENCY_MIN_SAMPLES, factor=REQUEST_TIMEOUT_FACTOR):
+        self.max_samples = samples
+        self.min_samples = min_samples
+        self.factor = factor
+        self.samples = {}
+        self.counts = {"timeouts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0}
+
+    def record(self, budget, latency):
+        self.samples.setdefault(budget, deque(maxlen=self.max_samples)).append(latency)
+
+    def percentile(self, budget, q):
+        """The q-th percentile latency of the budget, or None while it has too few samples."""
+        samples = self.samples.get(budget)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        return float(np.percentile(samples, q))
+
+    def timeout(self, budget):
+        p95 = self.percentile(budget, 95)
+        if p95 is None:
+            return REQUEST_TIMEOUT_SECONDS
+        return min(REQUEST_TIMEOUT_MAX_SECONDS, max(REQUEST_TIMEOUT_MIN_SECONDS, p95 * self.factor))
+
+    def hedge_delay(self, budget):
+        return self.percentile(budget, HEDGE_PERCENTILE)
+
+    def print_stats(self):
+        for budget in sorted(self.samples):
+            timeout = self.timeout(budget)
+            if self.percentile(budget, 50) is None:
+                print(f"⏱️ {budget}: {len(self.samples[budget])} samples | timeout {timeout:.0f}s")
+                continue
+            p50, p95, p99 = (self.percentile(budget, q) for q in (50, 95, 99))
+            print(f"⏱️ {budget}: p50 {p50:.1f}s | p95 {p95:.1f}s | p99 {p99:.1f}s | timeout {timeout:.0f}s")
+        counts = self.counts
+        print(f"⏱️ {counts['timeouts']} timeouts | {counts['retries']} backoff retries | "
+              f"{counts['hedges']} hedged requests ({counts['hedge_wins']} won by the hedge)")
+
+
+def call_with_timeout(func, timeout):
+    """Run func() in a daemon thread and raise TimeoutError if it takes longer than timeout.
+
+    A hung call is abandoned rather than joined, so one stalled socket cannot freeze the run
+    (the client's HTTP timeout eventually ends the thread).
+    """
+    result = {}
+
+    def run():
+        try:
+            result["value"] = func()
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f"no response after {timeout:.1f}s")
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+def transient_outcome(error):
+    """Outcome label of a non-client error: "timeout", "server_error" (5xx) or "error"."""
+    if isinstance(error, TimeoutError):
+        return "timeout"
+    if isinstance(error, genai.errors.ServerError):
+        return "server_error"
+    return "error"
+
+def backoff_delay(attempt):
+    """Exponential backoff with jitter for the attempt-th retry (1-based)."""
+    delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+
+# ----------------- SHARED PROMPT PREFIX -----------------
+
+def split_prompt(template):
+    """(instructions, payload template) of a TASKS prompt template.
+
+    The payload is the paragraph holding the {} placeholder (usually the input label and
+    the input); everything before it is the static instructions shared by every request
+    of the task. A template with text after that paragraph is sent whole, inline.
+    """
+    paragraphs = template.split("\n\n")
+    placeholder = next(i for i, paragraph in enumerate(paragraphs) if "{}" in paragraph)
+    if placeholder < len(paragraphs) - 1:
+        return "", template
+    return "\n\n".join(paragraphs[:placeholder]).strip(), paragraphs[placeholder]
+
+def task_request(task, input_text):
+    """generate_content arguments for one input: the row's prompt plus the task's instructions, model and config."""
+    instructions, payload = split_prompt(task["prompt_template"])
+    return {"prompt": payload.format(input_text), "instructions": instructions or None,
+            "model": task["model"], "config": task["config"]}
+
+def is_prompt_error(error):
+    """True for client errors caused by how instructions were sent (not by the key itself)."""
+    message = str(error).lower()
+    return ((getattr(error, "code", None) == 400 and "instruction" in message)
+            or "cachedcontent" in message.replace(" ", "").replace("_", ""))
+
+class PromptPrefixes:
+    """Decides how each request carries its task's static instructions.
+
+    "system" sends them as system_instruction, so the prompt is just the row's payload.
+    "cached" keeps a context cache of the instructions per key (caches belong to the
+    key's project) and task, recreated shortly before its TTL runs out; where caching
+    is unavailable the instructions go out as system_instruction. A model that
+    rejects system instructions switches the run to "inline", the original prompt.
+    """
+
+    def __init__(self, mode=PROMPT_MODE, ttl_seconds=PROMPT_CACHE_TTL_SECONDS):
+        self.mode = mode
+        self.ttl_seconds = ttl_seconds
+        self.caches = {}  # (key index, model, instructions) -> (cache name, expiry time), or None if unavailable
+        self.uncacheable = set()  # (model, instructions) below the model's minimum cache size
+        self.lock = threading.Lock()
+
+    def _cached_content(self, client, index, model, instructions):
+        """Name of a live context cache with the instructions on this key, created if needed."""
+        with self.lock:
+            if (model, instructions) in self.uncacheable:
+                return None
+            entry = self.caches.get((index, model, instructions), ())
+            if entry is None:
+                return None
+            if entry and entry[1] - time.time() > 60:
+                return entry[0]
+            try:
+                cached = client.caches.create(model=model, config=types.CreateCachedContentConfig(
+                    system_instruction=instructions, ttl=f"{self.ttl_seconds}s"
+                ))
+            except Exception as e:
+                if "min_total_token_count" in str(e):
+                    self.uncacheable.add((model, instructions))
+                else:
+                    self.caches[(index, model, instructions)] = None
+                metrics.inc("prompt_caches_total", status="failed")
+                metrics.log(f"🗃️ Context cache unavailable ({e}); sending instructions as system_instruction",
+                            "prompt_cache_failed", error=str(e))
+                return None
+            self.caches[(index, model, instructions)] = (cached.name, time.time() + self.ttl_seconds)
+            metrics.inc("prompt_caches_total", status="ok")
+            return cached.name
+
+    def request(self, client, index, prompt, instructions, config=None, model=MODEL_NAME):
+        """(contents, config) of one request on key index."""
+        if instructions is None:
+            return prompt, config
+        if self.mode == "inline":
+            return f"{instructions}\n\n{prompt}", config
+        update = {"system_instruction": instructions}
+        if self.mode == "cached":
+            name = self._cached_content(client, index, model, instructions)
+            if name is not None:
+                update = {"cached_content": name}
+        return prompt, (config or types.GenerateContentConfig()).model_copy(update=update)
+
+    def fallback(self, index, instructions, error, model=MODEL_NAME):
+        """Stop sending instructions the way that caused error (see is_prompt_error)."""
+        if "cachedcontent" in str(error).lower().replace(" ", "").replace("_", ""):
+            with self.lock:
+                self.caches[(index, model, instructions)] = None
+            metrics.log(f"🗃️ Context cache rejected ({error}); sending instructions as system_instruction",
+                        "prompt_cache_failed", error=str(error))
+        elif self.mode != "inline":
+            self.mode = "inline"
+            metrics.event("prompt_mode_fallback", error=str(error))
+            print(f"⚠️ {model} rejected system instructions ({error}); sending them inline")
+
+    def print_stats(self):
+        """Input tokens per task and how many were served from a (context or implicit) cache."""
+        print(f"🧾 Instructions sent: {self.mode}")
+        for task in TASKS:
+            budgets = [task["output_column"], f"{task['output_column']} (segment)",
+                       f"{task['output_column']} (packed)"]
+            total = sum(metrics.total("tokens_total", task=budget, direction="input") for budget in budgets)
+            cached = sum(metrics.total("tokens_total", task=budget, direction="cached") for budget in budgets)
+            if total:
+                print(f"🧾 {task['output_column']}: {total:,} input tokens, {cached:,} from cache "
+                      f"({cached / total * 100:.1f}% saved)")
 
 
 # ----------------- API CLIENT MANAGER -----------------
 
+class KeyPoolExhausted(Exception):
+    """No key is usable now or within MAX_KEY_WAIT_SECONDS (all failed or out of quota).
+
+    Every later request would fail the same way, so this stops the run instead of
+    failing cells one by one; the journals let the next run resume.
+    """
+
 class GenAIClientManager:
-    def __init__(self, api_keys):
+    def __init__(self, api_keys, max_concurrency=MAX_CONCURRENCY, per_key_limit=PER_KEY_CONCURRENCY,
+                 cache=None, adaptive=ADAPTIVE_CONCURRENCY, prompt_mode=PROMPT_MODE):
         self.api_keys = api_keys
         self.key_names = [f"KEY_{i+1}" for i in range(len(api_keys))]
         self.index = 0
         self.request_count = 0
         self.key_usage_stats = {name: 0 for name in self.key_names}
         self.failed_keys = set()
+        self.clients = {}
+        self.scheduler = KeyPoolScheduler(api_keys, self.key_names)
+        self.cache = cache
+        self.latency = LatencyTracker()
+        self.prompts = PromptPrefixes(prompt_mode)
+
+        # Async mode state (bound to the running event loop, see _ensure_async_state)
+        self.per_key_limit = per_key_limit
+        self.max_concurrency = max_concurrency or len(api_keys) * per_key_limit
+        self.controller = AdaptiveConcurrencyController(self.max_concurrency) if adaptive else None
+        self.in_flight = [0] * len(api_keys)
+        self._slot_available = None
+        self._loop = None
         
         print(f"🔑 Initialized with {len(self.api_keys)} API keys from .env file")
-        self.client = self._create_client(self.api_keys[self.index])
+        self.index = self.scheduler.pick_key() or 0
+        self.client = self._create_client(self.index)
+
+    def _create_client(self, index):
+        key_name = self.key_names[index]
+        try:
+            client = genai.Client(
+                api_key=self.api_keys[index],
+                http_options=types.HttpOptions(timeout=int(REQUEST_TIMEOUT_MAX_SECONDS * 1000))
+            )
+            print(f"✅ Successfully connected with {key_name}")
+            self.clients[index] = client
+            return client
+        except Exception as e:
+            print(f"❌ Error creating client with {key_name}: {e}")
+            self.failed_keys.add(index)
+            return None
+
+    def get_client(self):
+        return self.client
+
+    def get_client_for(self, index):
+        if index in self.clients:
+            return self.clients[index]
+        return self._create_client(index)
+
+    def get_current_key_info(self):
+        current_key_name = self.key_names[self.index]
+        return {
+            "name": current_key_name,
+            "index": self.index,
+            "usage_count": self.key_usage_stats[current_key_name],
+            "total_requests": self.request_count
+        }
+
+    def increment_usage(self, index=None):
+        if index is None:
+            index = self.index
+        self.request_count += 1
+        key_name = self.key_names[index]
+        self.key_usage_stats[key_name] += 1
+
+    def report_error(self, index, error):
+        """Cool a rate-limited key down and take an invalid or unauthorized key out of rotation.
+
+        Any other client error is the request's fault, not the key's (see is_key_error).
+        """
+        if is_rate_limit_error(error):
+            self.scheduler.report_rate_limit(index, error)
+        elif is_key_error(error) and index not in self.failed_keys:
+            self.failed_keys.add(index)
+            metrics.event("key_failed", key=self.key_names[index], error=str(error))
+            print(f"🚫 {self.key_names[index]} marked as failed | "
+                  f"Available keys: {len(self.api_keys) - len(self.failed_keys)}/{len(self.api_keys)}")
+
+    def _wait_time_or_raise(self, exclude):
+        wait = self.scheduler.seconds_until_available(exclude)
+        if wait is None or wait > MAX_KEY_WAIT_SECONDS:
+            raise KeyPoolExhausted("❌ All API keys have been exhausted or failed.")
+        return wait
+
+    def exhausted(self):
+        """True when no key will have headroom again within MAX_KEY_WAIT_SECONDS."""
+        try:
+            self._wait_time_or_raise(self.failed_keys)
+        except KeyPoolExhausted:
+            return True
+        return False
+
+    def select_key(self):
+        """Make the key with the most quota headroom current, waiting out cooldowns if needed."""
+        while True:
+            index = self.scheduler.pick_key(exclude=self.failed_keys)
+            if index is None:
+                wait = self._wait_time_or_raise(self.failed_keys)
+                metrics.log(f"⏳ All keys are cooling down, waiting {wait:.0f}s...", "keys_exhausted", wait_seconds=wait)
+                with metrics.timed("wait_seconds_total", stage="key"):
+                    time.sleep(max(wait, 1))
+                continue
+            if self.get_client_for(index) is None:
+                continue
+            if index != self.index:
+                self.index = index
+                self.client = self.clients[index]
+            self.scheduler.record_request(index)
+            return index
+
+    def switch_key(self, error=None):
+        old_key_name = self.key_names[self.index]
+        if error is not None:
+            self.report_error(self.index, error)
+        else:
+            self.failed_keys.add(self.index)
+
+        self.select_key()
+        print(f"🔄 Switching from {old_key_name} → {self.key_names[self.index]}")
+        print(f"📊 Available keys: {len(self.api_keys) - len(self.failed_keys)}/{len(self.api_keys)}")
+
+    # ----- async key leasing -----
+
+    def _ensure_async_state(self):
+        """Create the asyncio primitives for the current event loop.
+
+        Each asyncio.run() call starts a new loop, so the condition is rebuilt
+        whenever the loop changes.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._slot_available = asyncio.Condition()
+            self.in_flight = [0] * len(self.api_keys)
+
+    def _busy_keys(self):
+        return self.failed_keys | {
+            index for index in range(len(self.api_keys)) if self.in_flight[index] >= self.per_key_limit
+        }
+
+    async def acquire_key(self):
+        """Wait until some key has quota headroom and a free slot, and reserve it.
+
+        Returns the key index. Keys are handed out by most remaining headroom.
+        """
+        self._ensure_async_state()
+        with metrics.timed("wait_seconds_total", stage="key"):
+            return await self._acquire_key()
+
+    async def _acquire_key(self):
+        async with self._slot_available:
+            while True:
+                if len(self.failed_keys) >= len(self.api_keys):
+                    raise KeyPoolExhausted("❌ All API keys have been exhausted or failed.")
+                index = self.scheduler.pick_key(exclude=self._busy_keys())
+                if index is not None:
+                    if self.get_client_for(index) is None:
+                        continue
+                    self.in_flight[index] += 1
+                    metrics.set("requests_in_flight", sum(self.in_flight))
+                    self.scheduler.record_request(index)
+                    return index
+
+                if any(self.in_flight):
+                    # A slot or cooldown may free up; re-check at the latest when a cooldown ends
+                    timeout = self.scheduler.seconds_until_available(self.failed_keys)
+                else:
+                    timeout = self._wait_time_or_raise(self.failed_keys)
+                    metrics.log(f"⏳ All keys are cooling down, waiting {timeout:.0f}s...",
+                                "keys_exhausted", wait_seconds=timeout)
+                try:
+                    await asyncio.wait_for(self._slot_available.wait(), timeout=max(timeout or 1, 1))
+                except asyncio.TimeoutError:
+                    pass
+
+    def try_acquire_key(self, exclude=()):
+        """Reserve a key with headroom and a free slot right now, or return None without waiting."""
+        self._ensure_async_state()
+        index = self.scheduler.pick_key(exclude=self._busy_keys() | set(exclude))
+        if index is None or self.get_client_for(index) is None:
+            return None
+        self.in_flight[index] += 1
+        metrics.set("requests_in_flight", sum(self.in_flight))
+        self.scheduler.record_request(index)
+        return index
+
+    async def release_key(self, index, error=None):
+        async with self._slot_available:
+            self.in_flight[index] -= 1
+            metrics.set("requests_in_flight", sum(self.in_flight))
+            if error is not None:
+                self.report_error(index, error)
+            self._slot_available.notify_all()
+
+    def print_usage_stats(self):
+        self.scheduler.save_state()
+        print("\n📈 API Key Usage Statistics:")
+        print("=" * 40)
+        for index, key_name in enumerate(self.key_names):
+            usage = self.key_usage_stats[key_name]
+            status = "❌ Failed" if index in self.failed_keys else self.scheduler.status(index)
+            current = "🎯 Current" if index == self.index else ""
+            today = self.scheduler.requests_today[index]
+            print(f"{key_name}: {usage} requests | today {today}/{self.scheduler.rpd_limit} | {status} {current}")
+        print(f"Total requests made: {self.request_count}")
+        self.latency.print_stats()
+        self.prompts.print_stats()
+        if self.cache is not None:
+            self.cache.print_stats()
+        if self.controller is not None:
+            self.controller.print_stats()
+        print("=" * 40)
+
+# ----------------- TRANSLATION CACHE -----------------
+
+class TranslationCache:
+    """Single-file SQLite cache of translations, keyed by (model, prompt template, input text).
+
+    The cache is shared by every process that points at the same file (WAL mode), so
+    re-runs and duplicate rows across split files cost no quota. When the stored text
+    grows past max_mb, the least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_file=CACHE_FILE, max_mb=CACHE_MAX_MB):
+        self.cache_file = cache_file
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_evict = 0
+        self._pending = {}  # key -> asyncio.Future for requests already in flight
+
+        self.conn = sqlite3.connect(cache_file, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS translations (
+                key TEXT PRIMARY KEY,
+                output TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON translations (last_used)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model, prompt_template, input_text):
+        payload = json.dumps([model, prompt_template, str(input_text)], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        row = self.conn.execute("SELECT output FROM translations WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            metrics.inc("cache_lookups_total", result="miss")
+            return None
+        self.hits += 1
+        metrics.inc("cache_lookups_total", result="hit")
+        self.conn.execute("UPDATE translations SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return row[0]
+
+    def put(self, key, output):
+        size = len(output.encode("utf-8"))
+        self.conn.execute(
+            "INSERT OR REPLACE INTO translations (key, output, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, output, size, time.time())
+        )
+        self.conn.commit()
+        self._puts_since_evict += 1
+        if self._puts_since_evict >= CACHE_EVICT_EVERY:
+            self.evict()
+
+    def delete(self, keys):
+        """Drop entries, e.g. outputs that failed validation, so the next lookup is a miss."""
+        self.conn.executemany("DELETE FROM translations WHERE key = ?", [(key,) for key in keys])
+        self.conn.commit()
+
+    def contains(self, keys):
+        """The subset of keys that have a cached translation, without touching hit counts or recency."""
+        keys = list(keys)
+        found = set()
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            found.update(key for (key,) in self.conn.execute(
+                f"SELECT key FROM translations WHERE key IN ({placeholders})", batch
+            ))
+        return found
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes."""
+        self._puts_since_evict = 0
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM translations").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        doomed = []
+        for key, size in self.conn.execute("SELECT key, size FROM translations ORDER BY last_used"):
+            doomed.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self.conn.executemany("DELETE FROM translations WHERE key = ?", doomed)
+        self.conn.commit()
+        print(f"🧹 Translation cache evicted {len(doomed)} entries ({freed / 1024 / 1024:.1f} MB)")
+
+    def print_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0.0
+        entries = self.conn.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+        print(f"💾 Translation cache: {self.hits} hits / {self.misses} misses "
+              f"({hit_rate:.1f}% hit rate) | {entries} entries in {self.cache_file}")
+
+    def close(self):
+        self.conn.close()
+
+# ----------------- GENERATE -----------------
+
+def generate_content(client_manager, prompt, config=None, budget="default", instructions=None, model=MODEL_NAME):
+    """Send one request, switching keys on client errors.
+
+    instructions, if given, are the task's static instructions, sent the way
+    client_manager.prompts decides (system_instruction, context cache or inline).
+
+    A 429 cools the key down and an invalid key is taken out of rotation; neither
+    counts as a failed attempt, so the request goes on until the key pool itself
+    gives up (every key failed, or no quota frees up within MAX_KEY_WAIT_SECONDS).
+
+    Each attempt is bounded by the budget's timeout; timeouts, 5xx and unexpected
+    errors are retried with exponential backoff up to TRANSIENT_RETRIES times.
+    A response that stopped early is requested again up to VALIDATION_RETRIES times.
+    """
+    latency = client_manager.latency
+    max_retries = len(client_manager.api_keys)
+    attempts = 0
+    transient_count = 0
+    incomplete_count = 0
+    prompt_errors = 0
+    
+    while True:
+        # Use the key with the most quota headroom (waits out cooldowns if needed;
+        # KeyPoolExhausted stops the run)
+        client_manager.select_key()
+
+        client = client_manager.get_client()
+        current_key_info = client_manager.get_current_key_info()
+        
+        try:
+            # Show which key is being used
+            if attempts == 0:  # Only show on first attempt to avoid spam
+                metrics.log(f"🔑 Using {current_key_info['name']} (Usage: {current_key_info['usage_count']})")
+            attempts += 1
+            
+            contents, request_config = client_manager.prompts.request(
+                client, current_key_info['index'], prompt, instructions, config, model
+            )
+            started = time.monotonic()
+            response = call_with_timeout(
+                lambda: client.models.generate_content(model=model, contents=contents, config=request_config),
+                latency.timeout(budget)
+            )
+            elapsed = time.monotonic() - started
+            latency.record(budget, elapsed)
+            metrics.record_request(current_key_info['name'], budget, "ok", elapsed, response)
+            
+            # Increment usage counter on successful request
+            client_manager.increment_usage()
+            if not response_finished(response, budget):
+                incomplete_count += 1
+                if incomplete_count > VALIDATION_RETRIES:
+                    metrics.log(f"❌ Giving up after {VALIDATION_RETRIES} incomplete responses for {budget}",
+                                "gave_up", task=budget, reason="incomplete")
+                    return None
+                continue
+            return response.text
+            
+        except genai.errors.ClientError as e:
+            if is_prompt_error(e) and prompt_errors <= max_retries:
+                # The key is fine; send the instructions another way and try again
+                prompt_errors += 1
+                metrics.record_request(current_key_info['name'], budget, "error")
+                client_manager.prompts.fallback(current_key_info['index'], instructions, e, model)
+                continue
+            metrics.record_request(current_key_info['name'], budget,
+                                   "rate_limited" if is_rate_limit_error(e) else "error")
+            metrics.log(f"⚠️ API error with {current_key_info['name']}: {e}",
+                        "api_error", key=current_key_info['name'], task=budget, error=str(e))
+            
+            # Rate-limited keys cool down in the key pool, so the retry can go out right away
+            client_manager.report_error(current_key_info['index'], e)
+            if not (is_rate_limit_error(e) or is_key_error(e)):
+                # A bad request (400) or model (404) fails the same way on every key
+                metrics.log(f"❌ Request for {budget} rejected: {e}", "request_rejected", task=budget, error=str(e))
+                return None
+            metrics.log("🔄 Attempting to switch to next API key...")
+                
+        except Exception as e:
+            outcome = transient_outcome(e)
+            if outcome == "timeout":
+                latency.counts["timeouts"] += 1
+            metrics.record_request(current_key_info['name'], budget, outcome)
+            transient_count += 1
+            if transient_count > TRANSIENT_RETRIES:
+                metrics.log(f"❌ Giving up after {TRANSIENT_RETRIES} retries, last error with "
+                            f"{current_key_info['name']}: {e}", "gave_up", task=budget, error=str(e))
+                return None
+            delay = backoff_delay(transient_count)
+            latency.counts["retries"] += 1
+            metrics.log(f"⚠️ Transient error with {current_key_info['name']}: {e} | "
+                        f"retry {transient_count}/{TRANSIENT_RETRIES} in {delay:.1f}s",
+                        "transient_error", key=current_key_info['name'], task=budget, outcome=outcome,
+                        error=str(e), retry=transient_count, delay_seconds=delay)
+            with metrics.timed("wait_seconds_total", stage="backoff"):
+                time.sleep(delay)
+
+async def attempt_request_async(client_manager, index, prompt, config, budget, timeout, instructions=None,
+                                model=MODEL_NAME):
+    """One request on an already leased key. The key is always released afterwards."""
+    key_name = client_manager.key_names[index]
+    client = client_manager.get_client_for(index)
+    prompts = client_manager.prompts
+    error = None
+    started = time.monotonic()
+    try:
+        if prompts.mode == "cached" and instructions is not None:
+            # Creating a context cache is a blocking call
+            contents, config = await asyncio.to_thread(prompts.request, client, index, prompt, instructions, config,
+                                                       model)
+        else:
+            contents, config = prompts.request(client, index, prompt, instructions, config, model)
+        response = await asyncio.wait_for(
+            client.aio.models.generate_content(model=model, contents=contents, config=config),
+            timeout=timeout
+        )
+        elapsed = time.monotonic() - started
+        client_manager.latency.record(budget, elapsed)
+        metrics.record_request(key_name, budget, "ok", elapsed, response)
+        client_manager.increment_usage(index)
+        return response
+    except asyncio.TimeoutError:
+        metrics.record_request(key_name, budget, "timeout")
+        raise TimeoutError(f"no response from {key_name} after {timeout:.1f}s") from None
+    except asyncio.CancelledError:
+        metrics.record_request(key_name, budget, "cancelled")
+        raise
+    except genai.errors.ClientError as e:
+        metrics.record_request(key_name, budget, "rate_limited" if is_rate_limit_error(e) else "error")
+        if is_prompt_error(e):
+            # Not the key's fault: keep it in rotation and send the instructions another way
+            prompts.fallback(index, instructions, e, model)
+            raise
+        error = e
+        metrics.log(f"⚠️ API error with {key_name}: {e}", "api_error", key=key_name, task=budget, error=str(e))
+        raise
+    except Exception as e:
+        metrics.record_request(key_name, budget, transient_outcome(e))
+        raise
+    finally:
+        await client_manager.release_key(index, error=error)
+
+async def request_with_hedge(client_manager, index, prompt, config, budget, instructions=None, model=MODEL_NAME):
+    """Send the request on the leased key, hedging it on another key if it runs long.
+
+    Once the request outlives the budget's p90 latency, a duplicate goes out on
+    another key (if one is free right now) and the first successful response wins;
+    the other request is cancelled. Raises the primary request's error if no copy
+    succeeds.
+    """
+    latency = client_manager.latency
+    timeout = latency.timeout(budget)
+    primary = asyncio.ensure_future(
+        attempt_request_async(client_manager, index, prompt, config, budget, timeout, instructions, model)
+    )
+    tasks = [primary]
+    try:
+        hedge_after = latency.hedge_delay(budget) if HEDGE_REQUESTS else None
+        if hedge_after is None or hedge_after >= timeout:
+            return await primary
+
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        hedge_index = None if done else client_manager.try_acquire_key(exclude={index})
+        if hedge_index is None:
+            return await primary
+
+        latency.counts["hedges"] += 1
+        metrics.log(f"🪁 {client_manager.key_names[index]} slower than p{HEDGE_PERCENTILE} ({hedge_after:.1f}s), "
+                    f"hedging on {client_manager.key_names[hedge_index]}",
+                    "hedge", key=client_manager.key_names[index], hedge_key=client_manager.key_names[hedge_index],
+                    task=budget, after_seconds=hedge_after)
+        hedge = asyncio.ensure_future(
+            attempt_request_async(client_manager, hedge_index, prompt, config, budget, timeout - hedge_after,
+                                  instructions, model)
+        )
+        tasks.append(hedge)
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        latency.counts["hedge_wins"] += 1
+                    return task.result()
+        raise primary.exception()
+    finally:
+        unfinished = [task for task in tasks if not task.done()]
+        for task in unfinished:
+            task.cancel()
+        if unfinished:
+            await asyncio.gather(*unfinished, return_exceptions=True)
+
+async def generate_content_async(client_manager, prompt, config=None, budget="default", instructions=None,
+                                 model=MODEL_NAME):
+    """Async counterpart of generate_content.
+
+    Leases a key slot from the client manager for the duration of the call, so
+    many requests can be in flight at once without exceeding the per-key limit.
+    When adaptive concurrency is on, each attempt also takes a slot in the
+    controller's window and reports its outcome and latency back to it.
+    A 429 cools the key down and an invalid key is taken out of rotation, and the
+    request is retried on another key until the key pool gives up; other client
+    errors (400, 404) fail the request; timeouts, 5xx and unexpected errors are
+    retried with exponential backoff. Slow requests may be hedged (see request_with_hedge), and
+    responses that stopped early are requested again up to VALIDATION_RETRIES times.
+    """
+    controller = client_manager.controller
+    latency = client_manager.latency
+    max_retries = len(client_manager.api_keys)
+    transient_count = 0
+    incomplete_count = 0
+    prompt_errors = 0
+
+    while True:
+        if controller is not None:
+            await controller.acquire()
+        outcome = "error"
+        started = time.monotonic()
+        delay = 0
+        try:
+            index = await client_manager.acquire_key()  # KeyPoolExhausted stops the run
+
+            try:
+                response = await request_with_hedge(client_manager, index, prompt, config, budget, instructions,
+                                                    model)
+                outcome = "ok"
+                if response_finished(response, budget):
+                    return response.text
+                incomplete_count += 1
+                if incomplete_count > VALIDATION_RETRIES:
+                    metrics.log(f"❌ Giving up after {VALIDATION_RETRIES} incomplete responses for {budget}",
+                                "gave_up", task=budget, reason="incomplete")
+                    return None
+
+            except genai.errors.ClientError as e:
+                outcome = "rate_limited" if is_rate_limit_error(e) else "error"
+                if is_prompt_error(e) and prompt_errors <= max_retries:
+                    prompt_errors += 1
+                    continue
+                if not (is_rate_limit_error(e) or is_key_error(e)):
+                    # A bad request (400) or model (404) fails the same way on every key
+                    metrics.log(f"❌ Request for {budget} rejected: {e}", "request_rejected",
+                                task=budget, error=str(e))
+                    return None
+
+            except Exception as e:
+                outcome = transient_outcome(e)
+                if outcome == "timeout":
+                    latency.counts["timeouts"] += 1
+                transient_count += 1
+                if transient_count > TRANSIENT_RETRIES:
+                    metrics.log(f"❌ Giving up after {TRANSIENT_RETRIES} retries, last error: {e}",
+                                "gave_up", task=budget, error=str(e))
+                    return None
+                delay = backoff_delay(transient_count)
+                latency.counts["retries"] += 1
+                metrics.log(f"⚠️ Transient error: {e} | retry {transient_count}/{TRANSIENT_RETRIES} in {delay:.1f}s",
+                            "transient_error", task=budget, outcome=outcome, error=str(e),
+                            retry=transient_count, delay_seconds=delay)
+        finally:
+            if controller is not None:
+                await controller.release(outcome, time.monotonic() - started)
+
+        # Back off outside the controller window so other requests can use the slot
+        if delay:
+            with metrics.timed("wait_seconds_total", stage="backoff"):
+                await asyncio.sleep(delay)
+
+def translate_text(client_manager, task, input_text, budget=None):
+    """Translate one cell, consulting the translation cache before calling the API."""
+    if is_segmented(task, input_text):
+        return translate_segmented(client_manager, task, input_text)
+    budget = budget or task["output_column"]
+    cache = client_manager.cache
+    if cache is None:
+        return generate_content(client_manager, **task_request(task, input_text), budget=budget)
+
+    key = cache.make_key(task["model"], task["prompt_template"], input_text)
+    output = cache.get(key)
+    if output is None:
+        output = generate_content(client_manager, **task_request(task, input_text), budget=budget)
+        if output:
+            cache.put(key, output)
+    return output
+
+async def translate_text_async(client_manager, task, input_text, semaphore, budget=None):
+    """Async counterpart of translate_text.
+
+    Identical inputs that are already in flight share one request instead of
+    each spending quota. The semaphore only bounds actual API calls. budget names
+    the latency budget (default: the task's output column).
+    """
+    if is_segmented(task, input_text):
+        return await translate_segmented_async(client_manager, task, input_text, semaphore)
+    budget = budget or task["output_column"]
+    cache = client_manager.cache
+    request = task_request(task, input_text)
+    if cache is None:
+        async with semaphore:
+            return await generate_content_async(client_manager, **request, budget=budget)
+
+    key = cache.make_key(task["model"], task["prompt_template"], input_text)
+    output = cache.get(key)
+    if output is not None:
+        return output
+    if key in cache._pending:
+        return await asyncio.shield(cache._pending[key])
+
+    future = asyncio.get_running_loop().create_future()
+    cache._pending[key] = future
+    try:
+        async with semaphore:
+            output = await generate_content_async(client_manager, **request, budget=budget)
+        if output:
+            cache.put(key, output)
+        future.set_result(output)
+        return output
+    except BaseException:
+        future.set_result(None)
+        raise
+    finally:
+        del cache._pending[key]
+
+# ----------------- LONG-FORM SEGMENTATION -----------------
+
+PARAGRAPH_BREAK = r"(\n\s*\n)"
+SENTENCE_BREAK = r"(?<=[.!?।])(\s+)"
+WORD_BREAK = r"(\s+)"
+
+def is_segmented(task, input_text):
+    return SEGMENT_LONG_FORM and task.get("long_form", False) and len(str(input_text)) > SEGMENT_MAX_CHARS
+
+def _split_units(text, max_chars, breaks):
+    """(piece, separator) pairs of at most max_chars, split at the coarsest break that works."""
+    if len(text) <= max_chars:
+        return [(text, "")]
+    if not breaks:
+        return [(text[i:i + max_chars], "") for i in range(0, len(text), max_chars)]
+    parts = re.split(breaks[0], text)
+    units = []
+    for piece, separator in zip(parts[0::2], parts[1::2] + [""]):
+        sub_units = _split_units(piece, max_chars, breaks[1:])
+        sub_units[-1] = (sub_units[-1][0], sub_units[-1][1] + separator)
+        units.extend(sub_units)
+    return units
+
+def split_segments(text, max_chars=SEGMENT_MAX_CHARS):
+    """Split text into (segment, separator) pairs of at most max_chars characters.
+
+    Paragraph breaks are preferred, then sentence ends, then whitespace. Adjacent
+    pieces are merged up to max_chars, and joining every segment + separator gives
+    back the original text.
+    """
+    segments = []
+    current, current_separator = "", ""
+    for unit, separator in _split_units(str(text), max_chars, [PARAGRAPH_BREAK, SENTENCE_BREAK, WORD_BREAK]):
+        if (current or current_separator) and len(current) + len(current_separator) + len(unit) > max_chars:
+            segments.append((current, current_separator))
+            current = unit
+        else:
+            current = current + current_separator + unit
+        current_separator = separator
+    segments.append((current, current_separator))
+    return segments
+
+def segment_output_ok(source, output):
+    """A segment translation is usable if it is non-empty and not suspiciously short (truncated)."""
+    if not source.strip():
+        return True
+    return bool(output and output.strip()) and len(output.strip()) >= SEGMENT_MIN_OUTPUT_RATIO * len(source.strip())
+
+def assemble_segments(segments, outputs):
+    """Join segment translations in order with the original separators between them."""
+    return "".join(output.strip() + separator for output, (_, separator) in zip(outputs, segments)).strip()
+
+def _finish_segmented(client_manager, task, input_text, segments, outputs):
+    """Verify and assemble segment outputs; cache and return the result, or None if it fails."""
+    failed = sum(not segment_output_ok(text, output) for (text, _), output in zip(segments, outputs))
+    output = assemble_segments(segments, outputs) if not failed else None
+    if failed or not segment_output_ok(input_text, output):
+        metrics.inc("segmented_cells_total", task=task["output_column"], status="failed")
+        metrics.log(f"❌ {failed}/{len(segments)} segments of a {task['input_column']} input still failed "
+                    f"after {SEGMENT_RETRIES} retries; leaving the cell pending",
+                    "segmentation_failed", task=task["output_column"], segments=len(segments), failed=failed)
+        return None
+
+    metrics.inc("segmented_cells_total", task=task["output_column"], status="ok")
+    metrics.inc("segments_total", len(segments), task=task["output_column"])
+    cache = client_manager.cache
+    if cache is not None:
+        cache.put(cache.make_key(task["model"], task["prompt_template"], input_text), output)
+    return output
+
+def _log_segment_retry(task, failed, segments, attempt):
+    metrics.log(f"🧱 {len(failed)}/{len(segments)} segments of a {task['input_column']} input failed "
+                f"verification, redoing them ({attempt}/{SEGMENT_RETRIES})",
+                "segment_retry", task=task["output_column"], segments=len(segments), failed=len(failed),
+                attempt=attempt)
+
+def translate_segmented(client_manager, task, input_text):
+    """Sync counterpart of translate_segmented_async; segments are requested one after another."""
+    cache = client_manager.cache
+    if cache is not None:
+        output = cache.get(cache.make_key(task["model"], task["prompt_template"], input_text))
+        if output is not None:
+            return output
+
+    segments = split_segments(input_text)
+    budget = f"{task['output_column']} (segment)"
+    outputs = [text if not text.strip() else translate_text(client_manager, task, text, budget=budget)
+               for text, _ in segments]
+    for attempt in range(1, SEGMENT_RETRIES + 1):
+        failed = [i for i, (text, _) in enumerate(segments) if not segment_output_ok(text, outputs[i])]
+        if not failed:
+            break
+        _log_segment_retry(task, failed, segments, attempt)
+        for i in failed:
+            # Bypass the cache: it may hold the rejected output
+            outputs[i] = generate_content(client_manager, **task_request(task, segments[i][0]), budget=budget)
+            if cache is not None and segment_output_ok(segments[i][0], outputs[i]):
+                cache.put(cache.make_key(task["model"], task["prompt_template"], segments[i][0]), outputs[i])
+    return _finish_segmented(client_manager, task, input_text, segments, outputs)
+
+async def translate_segmented_async(client_manager, task, input_text, semaphore):
+    """Translate a long-form input as independent segment requests running in parallel.
+
+    Segments go through translate_text_async, so they share the cache, in-flight
+    dedup and retry paths. Each segment's output is verified and failed segments are
+    requested again on their own, up to SEGMENT_RETRIES times. The reassembled text
+    is verified once more and cached for the whole input. Returns None if it still
+    fails, so the cell stays pending.
+    """
+    cache = client_manager.cache
+    if cache is not None:
+        output = cache.get(cache.make_key(task["model"], task["prompt_template"], input_text))
+        if output is not None:
+            return output
+
+    segments = split_segments(input_text)
+    budget = f"{task['output_column']} (segment)"
+
+    async def translate_segment(text):
+        if not text.strip():
+            return text
+        return await translate_text_async(client_manager, task, text, semaphore, budget=budget)
+
+    async def redo_segment(text):
+        # Bypass the cache: it may hold the rejected output
+        async with semaphore:
+            output = await generate_content_async(client_manager, **task_request(task, text), budget=budget)
+        if cache is not None and segment_output_ok(text, output):
+            cache.put(cache.make_key(task["model"], task["prompt_template"], text), output)
+        return output
+
+    outputs = list(await asyncio.gather(*(translate_segment(text) for text, _ in segments)))
+    for attempt in range(1, SEGMENT_RETRIES + 1):
+        failed = [i for i, (text, _) in enumerate(segments) if not segment_output_ok(text, outputs[i])]
+        if not failed:
+            break
+        _log_segment_retry(task, failed, segments, attempt)
+        redone = await asyncio.gather(*(redo_segment(segments[i][0]) for i in failed))
+        for i, output in zip(failed, redone):
+            outputs[i] = output
+    return _finish_segmented(client_manager, task, input_text, segments, outputs)
+
+
+# ----------------- REQUEST PACKING -----------------
+
+def plan_packs(items, max_items=PACK_MAX_ITEMS, max_chars=PACK_MAX_CHARS):
+    """Group (cell_id, input_text) items into packs sized by input length.
+
+    Short inputs are packed greedily until max_items or max_chars is reached, so K
+    grows for short Question fields and stays at 1 for long inputs.
+    """
+    packs = []
+    current, current_chars = [], 0
+    for cell_id, input_text in items:
+        length = len(str(input_text))
+        if length > PACK_ITEM_MAX_CHARS:
+            packs.append([(cell_id, input_text)])
+            continue
+        if current and (len(current) >= max_items or current_chars + length > max_chars):
+            packs.append(current)
+            current, current_chars = [], 0
+        current.append((cell_id, input_text))
+        current_chars += length
+    if current:
+        packs.append(current)
+    return packs
+
+def build_packed_prompt(task, texts):
+    payload = json.dumps(
+        [{"id": str(i), "text": str(text)} for i, text in enumerate(texts, 1)],
+        ensure_ascii=False, indent=1
+    )
+    request = task_request(task, payload)
+    request["prompt"] += PACKED_PROMPT_NOTE
+    # The task's generation parameters still apply; the response schema comes from the pack
+    request["config"] = PACKED_RESPONSE_CONFIG.model_copy(
+        update=task["config"].model_dump(exclude_none=True) if task["config"] else {}
+    )
+    return request
+
+def parse_packed_response(raw, expected_count):
+    """Return {id: translation} from a packed JSON response, or None if it is unusable."""
+    if not raw:
+        return None
+    try:
+        entries = json.loads(raw)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(entries, list):
+        return None
+    translations = {}
+    for entry in entries:
+        if isinstance(entry, dict) and isinstance(entry.get("translation"), str) and entry["translation"].strip():
+            translations[str(entry.get("id"))] = entry["translation"]
+    expected_ids = {str(i) for i in range(1, expected_count + 1)}
+    return {item_id: text for item_id, text in translations.items() if item_id in expected_ids}
+
+async def translate_pack_async(client_manager, task, items, semaphore):
+    """Translate a pack of (cell_id, input_text) items with one request.
+
+    Returns {cell_id: output}. Items missing from the response are retried one by
+    one; a response that cannot be parsed at all splits the pack in half.
+    """
+    if len(items) == 1:
+        cell_id, input_text = items[0]
+        return {cell_id: await translate_text_async(client_manager, task, input_text, semaphore)}
+
+    cache = client_manager.cache
+    results = {}
+    pending = []
+    for cell_id, input_text in items:
+        cached = None
+        if cache is not None:
+            cached = cache.get(cache.make_key(task["model"], task["prompt_template"], input_text))
+        if cached is not None:
+            results[cell_id] = cached
+        else:
+            pending.append((cell_id, input_text))
+
+    if len(pending) <= 1:
+        if pending:
+            results.update(await translate_pack_async(client_manager, task, pending, semaphore))
+        return results
+
+    request = build_packed_prompt(task, [input_text for _, input_text in pending])
+    async with semaphore:
+        raw = await generate_content_async(
+            client_manager, **request, budget=f"{task['output_column']} (packed)"
+        )
+    translations = parse_packed_response(raw, len(pending))
+
+    if translations is None:
+        metrics.log(f"🧩 Packed response for {len(pending)} items was unusable, splitting the pack",
+                    "pack_split", task=task["output_column"], items=len(pending))
+        middle = len(pending) // 2
+        halves = await asyncio.gather(
+            translate_pack_async(client_manager, task, pending[:middle], semaphore),
+            translate_pack_async(client_manager, task, pending[middle:], semaphore)
+        )
+        for half in halves:
+            results.update(half)
+        return results
+
+    missing = []
+    for item_id, (cell_id, input_text) in enumerate(pending, 1):
+        output = translations.get(str(item_id))
+        if output is None:
+            missing.append((cell_id, input_text))
+            continue
+        results[cell_id] = output
+        if cache is not None:
+            cache.put(cache.make_key(task["model"], task["prompt_template"], input_text), output)
+
+    if missing:
+        metrics.log(f"🧩 Pack returned {len(pending) - len(missing)}/{len(pending)} items, retrying the rest individually",
+                    "pack_partial", task=task["output_column"], items=len(pending), missing=len(missing))
+        outputs = await asyncio.gather(*(
+            translate_text_async(client_manager, task, input_text, semaphore) for _, input_text in missing
+        ))
+        for (cell_id, _), output in zip(missing, outputs):
+            results[cell_id] = output
+    return results
+
+# ----------------- OUTPUT VALIDATION -----------------
+
+BANGLA_LETTERS = "[\u0980-\u09FF]"  # the Bengali block
+LATIN_LETTERS = r"[A-Za-z]"
+COMPLETE_FINISH_REASONS = {None, "STOP", "FINISH_REASON_UNSPECIFIED"}
+# "Here is the translation:", "Sure, ...", "অনুবাদ:", "নিচে প্রশ্নটির বাংলা অনুবাদ দেওয়া হলো:"
+COMMENTARY_PATTERN = (r"(?i)^\s*(?:here(?:'s| is)\b|sure\b|certainly\b|(?:bangla |bengali )?translation\s*:"
+                      r"|(?:এখানে|নিচে)[^\n]{0,40}অনুবাদ|অনুবাদ\s*:)")
+
+def response_finished(response, budget):
+    """True unless the response stopped early (MAX_TOKENS, SAFETY, ...), which is counted and logged."""
+    if not VALIDATE_OUTPUTS:
+        return True
+    candidates = getattr(response, "candidates", None) or []
+    reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+    reason = getattr(reason, "name", reason)
+    if reason in COMPLETE_FINISH_REASONS:
+        return True
+    metrics.inc("invalid_outputs_total", task=budget, reason="finish_reason")
+    metrics.log(f"✂️ Response for {budget} stopped with {reason}, requesting it again",
+                "invalid_output", task=budget, reason="finish_reason", finish_reason=str(reason))
+    return False
+
+def prompt_echo_pattern(task):
+    """Regex for the task's instruction lines, which only appear in an output that echoes the prompt."""
+    lines = [line.strip() for line in task["prompt_template"].splitlines()]
+    return "|".join(re.escape(line) for line in lines if len(line) >= 12 and "{}" not in line)
+
+def validate_outputs(df, task, rows=None):
+    """Check one task's finished outputs in df (or the given rows of it) in a single vectorized pass.
+
+    Returns a boolean DataFrame with a column per check, True where the output fails
+    it, for the rows that have output:
+    - bangla_ratio: less than VALIDATION_MIN_BANGLA_RATIO of its letters are Bangla
+    - length_ratio: output/input length outside the VALIDATION_*_LENGTH_RATIO bounds
+    The task's min_bangla_ratio, min_length_ratio and max_length_ratio override these
+    (null turns a bound off), e.g. for generation tasks whose output is not a translation.
+    - echo: contains the prompt's instructions or the (English) opening of the input
+    - commentary: opens with a wrapper like "Here is the translation:"
+    """
+    frame = df if rows is None else df.loc[rows]
+    outputs = frame[task["output_column"]]
+    finished = (outputs.notna() & (outputs.astype(str).str.strip() != "")).to_numpy()
+    outputs = outputs[finished].astype(str)
+    inputs = frame.loc[finished, task["input_column"]].fillna("").astype(str).str.strip()
+
+    bangla = outputs.str.count(BANGLA_LETTERS)
+    latin = outputs.str.count(LATIN_LETTERS)
+    letters = bangla + latin
+    min_bangla_ratio = task.get("min_bangla_ratio", VALIDATION_MIN_BANGLA_RATIO) or 0
+    bangla_ratio = (letters > 0) & (bangla < min_bangla_ratio * letters)
+
+    input_length = inputs.str.len()
+    length_ratio = outputs.str.strip().str.len() / input_length.where(input_length > 0)
+    min_length_ratio = task.get("min_length_ratio", VALIDATION_MIN_LENGTH_RATIO) or 0
+    max_length_ratio = task.get("max_length_ratio", VALIDATION_MAX_LENGTH_RATIO) or float("inf")
+    length_ratio = (input_length >= VALIDATION_MIN_INPUT_CHARS) & (
+        (length_ratio < min_length_ratio) | (length_ratio > max_length_ratio)
+    )
+
+    # Only openings that are mostly English prose count: numbers or formulas may be copied legitimately
+    probes = inputs.str.slice(0, VALIDATION_ECHO_CHARS)
+    probe_is_prose = (probes.str.len() >= VALIDATION_ECHO_CHARS) & (
+        probes.str.count(LATIN_LETTERS) >= VALIDATION_ECHO_CHARS // 2
+    )
+    input_echo = pd.Series([probe in output for probe, output in zip(probes, outputs)],
+                           index=outputs.index, dtype=bool) & probe_is_prose
+    echo_pattern = prompt_echo_pattern(task)
+    prompt_echo = outputs.str.contains(echo_pattern, regex=True) if echo_pattern else False
+
+    return pd.DataFrame({
+        "bangla_ratio": bangla_ratio,
+        "length_ratio": length_ratio,
+        "echo": input_echo | prompt_echo,
+        "commentary": outputs.str.contains(COMMENTARY_PATTERN, regex=True),
+    }, index=outputs.index)
+
+def requeue_invalid_cells(df, cells, journal, cache=None):
+    """Validate the outputs of the given (row, task) cells (None: every finished cell) and clear failing ones.
+
+    A cleared cell is journaled as rejected, its cached translation (and segments) is
+    dropped, and it is returned for translating again. Once a cell has been rejected
+    VALIDATION_RETRIES times its last output is kept and the failure only logged.
+    """
+    if not VALIDATE_OUTPUTS:
+        return []
+    if cells is None:
+        rows_by_task = {task_index: None for task_index in task_indices(df)}
+    else:
+        rows_by_task = {}
+        for row, task_index in cells:
+            rows_by_task.setdefault(task_index, []).append(row)
+
+    requeued = []
+    for task_index, rows in sorted(rows_by_task.items()):
+        task = TASKS[task_index]
+        if not task.get("validate", True):
+            continue
+        column = task["output_column"]
+        checks = validate_outputs(df, task, rows)
+        failed = checks[checks.any(axis=1)]
+        for check in checks.columns:
+            if failed[check].any():
+                metrics.inc("invalid_outputs_total", int(failed[check].sum()), task=column, reason=check)
+        for row, flags in zip(failed.index.tolist(), failed.to_numpy()):
+            reasons = [check for check, flag in zip(checks.columns, flags) if flag]
+            if journal.rejections[(row, column)] >= VALIDATION_RETRIES:
+                metrics.inc("invalid_outputs_kept_total", task=column)
+                metrics.log(f"⚠️ Row {row + 1} {column} still fails {', '.join(reasons)} after "
+                            f"{VALIDATION_RETRIES} retries; keeping it", "invalid_output_kept",
+                            row=row, task=column, reasons=reasons)
+                continue
+            input_text = df.at[row, task["input_column"]]
+            if cache is not None:
+                texts = [input_text]
+                if is_segmented(task, input_text):
+                    texts.extend(text for text, _ in split_segments(input_text))
+                cache.delete(cache.make_key(task["model"], task["prompt_template"], text) for text in texts)
+            df.at[row, column] = None
+            journal.reject(row, column, reasons)
+            metrics.event("invalid_output", row=row, task=column, reasons=reasons,
+                          attempt=journal.rejections[(row, column)])
+            requeued.append((row, task_index))
+
+            # Outputs made from the rejected one are redone after it
+            dependents = list(task["dependents"])
+            while dependents:
+                dependent = dependents.pop()
+                dependents.extend(TASKS[dependent]["dependents"])
+                dependent_column = TASKS[dependent]["output_column"]
+                if dependent_column in df.columns and not is_blank(df.at[row, dependent_column]):
+                    df.at[row, dependent_column] = None
+                    journal.reject(row, dependent_column, ["upstream"])
+                    requeued.append((row, dependent))
+
+    if requeued:
+        metrics.log(f"🔍 {len(requeued)} outputs failed validation, translating them again")
+    return sorted(requeued)
+
+# ----------------- PROCESSING -----------------
+
+def build_pending_index(df):
+    """Find every (row, task) cell that still needs output in one vectorized pass.
+
+    A cell is pending when its output is missing or empty and its input is not blank,
+    or, for a task that reads another task's output, that row's upstream cell is pending.
+    Returns a DataFrame with "row" (index label) and "task" (TASKS position) columns,
+    sorted by row and then task.
+    """
+    parts = []
+    pending_masks = {}
+    for task_index in task_indices(df):
+        task = TASKS[task_index]
+        outputs = df[task["output_column"]]
+        inputs = df[task["input_column"]]
+        missing_output = outputs.isna() | (outputs == "")
+        has_input = inputs.notna() & (inputs.astype(str).str.strip() != "")
+        if task["upstream"] in pending_masks:
+            has_input |= pending_masks[task["upstream"]]
+        pending_masks[task_index] = missing_output & has_input
+        rows = df.index[pending_masks[task_index].to_numpy()]
+        parts.append(pd.DataFrame({"row": rows.to_numpy(dtype=np.int64), "task": task_index}))
+    if not parts:
+        return pd.DataFrame({"row": np.array([], dtype=np.int64), "task": np.array([], dtype=np.int64)})
+    pending = pd.concat(parts, ignore_index=True)
+    return pending.sort_values(["row", "task"], kind="stable", ignore_index=True)
+
+def is_blank(value):
+    return value is None or pd.isna(value) or not str(value).strip()
+
+def split_ready_cells(df, cells):
+    """Split (row, task) cells into (ready, waiting, blocked).
+
+    A cell waits while its row's upstream cell is among cells; it is blocked when that
+    upstream cell is not pending but left no output to read.
+    """
+    pending = set(cells)
+    ready, waiting, blocked = [], set(), []
+    for row, task_index in cells:
+        task = TASKS[task_index]
+        if task["upstream"] is not None and (row, task["upstream"]) in pending:
+            waiting.add((row, task_index))
+        elif task["upstream"] is not None and is_blank(df.at[row, task["input_column"]]):
+            blocked.append((row, task_index))
+        else:
+            ready.append((row, task_index))
+    return ready, waiting, blocked
+
+def release_dependents(df, done, waiting):
+    """Take the cells waiting on the finished (row, task) cells out of waiting.
+
+    Returns (released, blocked): a dependent is released when its upstream cell has
+    output; otherwise it is blocked, and so is everything waiting on it in turn.
+    """
+    released, blocked = [], []
+    finished = list(done)
+    while finished:
+        row, task_index = finished.pop()
+        has_output = not is_blank(df.at[row, TASKS[task_index]["output_column"]])
+        for dependent in TASKS[task_index]["dependents"]:
+            if (row, dependent) not in waiting:
+                continue
+            waiting.discard((row, dependent))
+            if has_output:
+                released.append((row, dependent))
+            else:
+                blocked.append((row, dependent))
+                finished.append((row, dependent))
+    return sorted(released), blocked
+
+def record_blocked(blocked, progress=None):
+    """Count cells skipped because the output they read failed; they are pending again next run."""
+    for _, task_index in blocked:
+        metrics.inc("cells_total", task=TASKS[task_index]["output_column"], status="blocked")
+    if blocked and progress is not None:
+        progress.update(len(blocked))
+
+class TaskSlots:
+    """In-flight request slots shared by all tasks, with each task's share set by its weight.
+
+    A task holds at most ceil(limit * weight / heaviest weight) of the limit slots, so
+    with equal weights every task may use the whole window.
+    """
+
+    def __init__(self, limit):
+        heaviest = max((task["weight"] for task in TASKS), default=1) or 1
+        self.shared = asyncio.Semaphore(limit)
+        self.slots = [TaskSlot(asyncio.Semaphore(max(1, math.ceil(limit * task["weight"] / heaviest))), self.shared)
+                      for task in TASKS]
+
+    def for_task(self, task_index):
+        return self.slots[task_index]
+
+class TaskSlot:
+    """Async context manager taking one of a task's own slots, then one shared slot."""
+
+    def __init__(self, own, shared):
+        self.own = own
+        self.shared = shared
+
+    async def __aenter__(self):
+        await self.own.acquire()
+        try:
+            await self.shared.acquire()
+        except BaseException:
+            self.own.release()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        self.shared.release()
+        self.own.release()
+
+def cells_for_rows(pending, first_row, last_row):
+    """(row, task) pairs of the pending index with first_row <= row <= last_row."""
+    rows = pending["row"].to_numpy()
+    start = np.searchsorted(rows, first_row, side="left")
+    end = np.searchsorted(rows, last_row, side="right")
+    return list(zip(rows[start:end].tolist(), pending["task"].to_numpy()[start:end].tolist()))
 
-    def _create_client(self, api_key):
-        try:
-            client = genai.Client(api_key=api_key)
-            current_key_name = self.key_names[self.index]
-            print(f"✅ Successfully connected with {current_key_name}")
-            return client
-        except Exception as e:
-            current_key_name = self.key_names[self.index]
-            print(f"❌ Error creating client with {current_key_name}: {e}")
-            self.failed_keys.add(self.index)
-            return None
+async def process_rows_async(df, cells, client_manager, journal, progress, pack=PACK_REQUESTS):
+    """Translate the given pending (row, task) cells concurrently.
 
-    def get_client(self):
-        return self.client
+    At most client_manager.max_concurrency requests are in flight overall, split between
+    tasks by weight (see TaskSlots). Independent TASKS of a row run side by side, and each
+    result is written back to its own df cell and journaled. A cell reading another task's
+    output starts as soon as that row's upstream output is in and has passed validation.
+    With pack=True, short inputs of the same task share one structured-output request.
+    Returns the cells redone beyond the given ones (finished outputs made from a rejected one).
+    """
+    slots = TaskSlots(client_manager.max_concurrency)
+    ready, waiting, blocked = split_ready_cells(df, cells)
+    given = set(cells)
+    added = []
+    record_blocked(blocked, progress)
 
-    def get_current_key_info(self):
-        current_key_name = self.key_names[self.index]
-        return {
-            "name": current_key_name,
-            "index": self.index,
-            "usage_count": self.key_usage_stats[current_key_name],
-            "total_requests": self.request_count
-        }
+    async def run_cells(cells):
+        cells_by_task = {}
+        for idx, task_index in cells:
+            input_text = df.at[idx, TASKS[task_index]["input_column"]]
+            cells_by_task.setdefault(task_index, []).append((idx, input_text))
 
-    def increment_usage(self):
-        self.request_count += 1
-        current_key_name = self.key_names[self.index]
-        self.key_usage_stats[current_key_name] += 1
+        jobs = []
+        for task_index, items in cells_by_task.items():
+            packs = plan_packs(items) if pack else [[item] for item in items]
+            jobs.extend((task_index, items_in_pack) for items_in_pack in packs)
+        await asyncio.gather(*(run_pack(task_index, items) for task_index, items in jobs))
 
-    def switch_key(self):
-        old_key_name = self.key_names[self.index]
-        self.failed_keys.add(self.index)
-        
-        # Find next available key
-        original_index = self.index
-        while True:
-            self.index = (self.index + 1) % len(self.api_keys)
-            
-            # If we've cycled through all keys
-            if self.index == original_index:
-                available_keys = len(self.api_keys) - len(self.failed_keys)
-                if available_keys == 0:
-                    raise Exception("❌ All API keys have been exhausted or failed.")
-                break
-                
-            # If this key hasn't failed, try it
-            if self.index not in self.failed_keys:
-                break
-        
-        new_key_name = self.key_names[self.index]
-        print(f"🔄 Switching from {old_key_name} → {new_key_name}")
-        print(f"📊 Available keys: {len(self.api_keys) - len(self.failed_keys)}/{len(self.api_keys)}")
-        
-        self.client = self._create_client(self.api_keys[self.index])
-        
-        if self.client is None:
-            # If the new key also fails, try switching again
-            return self.switch_key()
+    async def run_pack(task_index, items):
+        task = TASKS[task_index]
+        results = await translate_pack_async(client_manager, task, items, slots.for_task(task_index))
+        for idx, output in results.items():
+            if output:
+                df.at[idx, task["output_column"]] = output
+                journal.record(idx, task["output_column"], output)
+            metrics.inc("cells_total", task=task["output_column"], status="ok" if output else "failed")
+        progress.update(len(items))
+        if not task["dependents"]:
+            return
 
-    def print_usage_stats(self):
-        print("\n📈 API Key Usage Statistics:")
-        print("=" * 40)
-        for key_name in self.key_names:
-            usage = self.key_usage_stats[key_name]
-            status = "❌ Failed" if self.key_names.index(key_name) in self.failed_keys else "✅ Active"
-            current = "🎯 Current" if self.key_names.index(key_name) == self.index else ""
-            print(f"{key_name}: {usage} requests | {status} {current}")
-        print(f"Total requests made: {self.request_count}")
-        print("=" * 40)
+        # Outputs other tasks read are validated before they are handed on; outputs made
+        # from a rejected one are cleared too and wait for it to be redone
+        done = [(idx, task_index) for idx, _ in items]
+        requeued = requeue_invalid_cells(df, done, journal, client_manager.cache)
+        new = [cell for cell in requeued if cell not in waiting]
+        added.extend(cell for cell in new if cell not in given)
+        redo, redo_waiting, redo_blocked = split_ready_cells(df, new)
+        waiting.update(redo_waiting)
+        if new:
+            progress.total += len(new)
+            progress.refresh()
+        released, blocked = release_dependents(df, [cell for cell in done if cell not in requeued], waiting)
+        record_blocked(redo_blocked + blocked, progress)
+        await run_cells(redo + released)
 
-# ----------------- GENERATE -----------------
+    await run_cells(ready)
+    return added
 
-def generate_content(client_manager, prompt):
-    max_retries = len(client_manager.api_keys)
-    retry_count = 0
-    
-    while retry_count < max_retries:
-        client = client_manager.get_client()
-        if client is None:
-            print("❌ No valid API client available.")
-            return None
-            
-        current_key_info = client_manager.get_current_key_info()
-        
-        try:
-            # Show which key is being used
-            if retry_count == 0:  # Only show on first attempt to avoid spam
-                print(f"🔑 Using {current_key_info['name']} (Usage: {current_key_info['usage_count']})")
-            
-            response = client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=prompt
-            )
-            
-            # Increment usage counter on successful request
-            client_manager.increment_usage()
-            return response.text
-            
-        except genai.errors.ClientError as e:
-            retry_count += 1
-            print(f"⚠️ API error with {current_key_info['name']}: {e}")
-            
-            if retry_count < max_retries:
-                print("🔄 Attempting to switch to next API key...")
-                try:
-                    client_manager.switch_key()
-                    time.sleep(2)  # Wait a bit before retrying
-                except Exception as switch_error:
-                    print(f"❌ Failed to switch keys: {switch_error}")
-                    return None
-            else:
-                print("❌ All API keys have been tried and failed.")
-                return None
-                
-        except Exception as e:
-            print(f"❌ Unexpected error with {current_key_info['name']}: {e}")
-            return None
-    
-    return None
+def process_rows(df, cells, client_manager, journal, progress, use_async=ASYNC_MODE, pack=PACK_REQUESTS):
+    """Translate the given pending (row, task) cells of df and journal each result.
 
-# ----------------- PROCESSING -----------------
+    The new outputs are then validated, and cells that fail go through again (see
+    requeue_invalid_cells), so only bad cells spend more quota. Outputs that other tasks
+    read are validated as they finish instead, before the cells reading them start.
+    """
+    while cells:
+        if use_async:
+            # Process all cells concurrently
+            cells = cells + asyncio.run(process_rows_async(df, cells, client_manager, journal, progress, pack=pack))
+        else:
+            # Process each cell in turn; pacing comes from the key pool's quotas and cooldowns.
+            # Cells are in (row, task) order, so a row's upstream cells come before their dependents.
+            queued = set(cells)
+            cells = list(cells)
+            for idx, task_index in cells:
+                task = TASKS[task_index]
+                if task["upstream"] is not None and is_blank(df.at[idx, task["input_column"]]):
+                    record_blocked([(idx, task_index)], progress)
+                    continue
+                while True:
+                    output = translate_text(client_manager, task, df.at[idx, task["input_column"]])
+                    if output:
+                        df.at[idx, task["output_column"]] = output
+                        journal.record(idx, task["output_column"], output)
+                    metrics.inc("cells_total", task=task["output_column"], status="ok" if output else "failed")
+                    progress.update(1)
+                    requeued = task["dependents"] and requeue_invalid_cells(df, [(idx, task_index)], journal,
+                                                                             client_manager.cache)
+                    if not requeued:
+                        break
+                    # Finished outputs made from the rejected one are redone after it
+                    redone_dependents = [cell for cell in requeued if cell not in queued]
+                    queued.update(redone_dependents)
+                    cells.extend(redone_dependents)
+                    progress.total += 1 + len(redone_dependents)
+                    progress.refresh()
 
-def get_working_file_path(original_file):
-    """Get the working file path - creates a working copy if it doesn't exist"""
-    working_file = original_file.with_name(f"working_{original_file.name}")
-    
-    if not working_file.exists():
-        # Create working copy from original
-        df = pd.read_csv(original_file)
-        # Add output columns if they don't exist
-        for task in TASKS:
-            if task["output_column"] not in df.columns:
-                df[task["output_column"]] = None
-        df.to_csv(working_file, index=False, encoding='utf-8-sig')
-        print(f"Created working file: {working_file}")
-    
-    return working_file
+        cells = [(idx, task_index) for idx, task_index in cells if not TASKS[task_index]["dependents"]]
+        cells = requeue_invalid_cells(df, cells, journal, client_manager.cache)
+        if cells:
+            progress.total += len(cells)
+            progress.refresh()
+
+def load_working_dataframe(file_path):
+    """Load the input CSV with every TASKS output column present and stored as text.
+
+    A working_<name>.csv left behind by older versions of this script is used instead
+    of the original when present, so its results are not lost.
+    """
+    legacy_working_file = file_path.with_name(f"working_{file_path.name}")
+    if isinstance(file_path, DatasetSource):
+        df = file_path.to_dataframe()
+    else:
+        df = pd.read_csv(legacy_working_file if legacy_working_file.exists() else file_path)
+    return prepare_output_columns(df)
+
+def prepare_output_columns(df):
+    """Add the missing output columns of the TASKS that apply to df and store them as text.
+
+    A task applies when df has its input column, directly or through the task it depends
+    on. Empty output columns are parsed as float, which cannot hold a translation.
+    """
+    for task in TASKS:
+        if root_input_column(task) not in df.columns:
+            continue
+        if task["output_column"] not in df.columns:
+            df[task["output_column"]] = None
+        df[task["output_column"]] = df[task["output_column"]].astype(object)
+    return df
 
-def process_csv_in_batches(file_path, client_manager):
-    """Process a single CSV file with its own progress tracking"""
-    progress_manager = ProgressManager(file_path.name)
-    working_file = get_working_file_path(file_path)
+def final_output_path(file_path, output_format=OUTPUT_FORMAT):
+    suffix = ".parquet" if output_format == "parquet" else ".csv"
+    return file_path.with_name(f"final_{file_path.stem}_bangla_output{suffix}")
+
+def export_results(file_path, output_format=OUTPUT_FORMAT):
+    """Write the final output from the input file plus its journal, without any API calls."""
+    df = load_working_dataframe(file_path)
+    restored = replay_journals(file_path.name, df)
+    final_file = final_output_path(file_path, output_format)
+    write_output(df, final_file)
+    print(f"💾 Exported {file_path.name} ({restored} journaled results) → {final_file}")
+    return final_file
+
+def process_csv_in_batches(file_path, client_manager, use_async=ASYNC_MODE, pack=PACK_REQUESTS,
+                           output_format=OUTPUT_FORMAT):
+    """Process a single CSV file with its own result journal"""
+    journal = ResultJournal(file_path.name)
     
     print(f"\n📂 Processing: {file_path.name}")
-    print(f"📊 Progress file: {progress_manager.progress_file}")
+    print(f"📓 Result journal: {journal.journal_file}")
     
-    # Load the working file
-    df = pd.read_csv(working_file)
+    # Load the input and replay results from earlier runs (including worker journals)
+    df = load_working_dataframe(file_path)
     total_rows = len(df)
+    restored = replay_journals(file_path.name, df, journal.rejections)
     
-    # Get resume point
-    current_batch, completed_rows = progress_manager.get_resume_point()
-    
-    if completed_rows > 0:
-        print(f"Resuming from batch {current_batch + 1}, row {completed_rows + 1}...")
+    if restored > 0:
+        print(f"Resuming with {restored} results restored from the journal...")
     else:
         print("Starting fresh processing...")
     
+    # Restored outputs that fail validation are redone along with the pending cells
+    requeue_invalid_cells(df, None, journal, client_manager.cache)
+    
     # Show initial API key status
     print(f"\n🔑 Current API Key: {client_manager.get_current_key_info()['name']}")
+    if use_async:
+        print(f"⚡ Async mode: up to {client_manager.max_concurrency} requests in flight, "
+              f"{client_manager.per_key_limit} per key"
+              f"{' (adaptive window)' if client_manager.controller else ''}")
+    if pack:
+        print(f"🧩 Request packing: up to {PACK_MAX_ITEMS} inputs / {PACK_MAX_CHARS} chars per request")
     
-    # Calculate batches
-    start_row = completed_rows
-    total_batches = (total_rows + BATCH_SIZE - 1) // BATCH_SIZE
+    # Only rows with pending cells are visited; finished rows cost nothing on resume
+    pending = build_pending_index(df)
+    pending_rows = pending["row"].unique()
+    print(f"🧮 Pending: {len(pending):,} cells in {len(pending_rows):,} of {total_rows:,} rows")
+    
+    # Calculate batches over the pending rows
+    total_batches = (len(pending_rows) + BATCH_SIZE - 1) // BATCH_SIZE
+    progress = progress_bar(total=len(pending), desc=file_path.name, unit="cell")
     
     try:
-        for batch_num in range(current_batch, total_batches):
-            batch_start = batch_num * BATCH_SIZE
-            batch_end = min(batch_start + BATCH_SIZE, total_rows)
+        for batch_num in range(total_batches):
+            batch_rows = pending_rows[batch_num * BATCH_SIZE:(batch_num + 1) * BATCH_SIZE]
+            cells = cells_for_rows(pending, batch_rows[0], batch_rows[-1])
             
-            print(f"\n📦 Processing Batch {batch_num + 1}/{total_batches} (rows {batch_start + 1} to {batch_end})")
+            print(f"\n📦 Processing Batch {batch_num + 1}/{total_batches} "
+                  f"(rows {batch_rows[0] + 1} to {batch_rows[-1] + 1}, {len(cells)} cells)")
             
             # Show current API key status at start of each batch
             key_info = client_manager.get_current_key_info()
             print(f"🔑 Active Key: {key_info['name']} | Usage: {key_info['usage_count']} requests")
             
-            # Process each row in the current batch
-            batch_progress = tqdm(range(max(batch_start, start_row), batch_end), 
-                                desc=f"Batch {batch_num + 1}")
-            
-            for idx in batch_progress:
-                row = df.iloc[idx]
-                row_updated = False
-                
-                # Process each task for this row
-                for task in TASKS:
-                    if pd.isna(row[task["output_column"]]) or row[task["output_column"]] == "":
-                        input_text = row[task["input_column"]]
-                        if pd.notna(input_text) and str(input_text).strip():
-                            prompt = task["prompt_template"].format(input_text)
-                            output = generate_content(client_manager, prompt)
-                            if output:
-                                df.at[idx, task["output_column"]] = output
-                                row_updated = True
-                
-                # Update progress after each row
-                progress_manager.save_progress(batch_num, idx, total_rows)
-                
-                # Small delay to avoid overwhelming the API
-                time.sleep(0.1)
-            
-            # Save batch completion
-            csv_stem = file_path.stem
-            batch_file = f"{csv_stem}_batch_{batch_num + 1}_complete.csv"
-            df.to_csv(batch_file, index=False, encoding='utf-8-sig')
+            process_rows(df, cells, client_manager, journal, progress, use_async=use_async, pack=pack)
             
-            # Update working file
-            df.to_csv(working_file, index=False, encoding='utf-8-sig')
-            
-            print(f"✅ Batch {batch_num + 1} completed and saved: {batch_file}")
+            journal.sync()
+            print(f"✅ Batch {batch_num + 1} completed (results in {journal.journal_file})")
             
             # Show API usage stats after each batch
             key_info = client_manager.get_current_key_info()
             print(f"📊 {key_info['name']} used {key_info['usage_count']} times total")
-            
-            # Reset start_row for next batch
-            start_row = 0
-            
-            # Save progress for completed batch
-            progress_manager.save_progress(batch_num + 1, batch_end - 1, total_rows)
     
     except KeyboardInterrupt:
+        progress.close()
+        journal.close()
         print(f"\n⏸️ Processing interrupted by user for {file_path.name}. Progress has been saved.")
-        df.to_csv(working_file, index=False, encoding='utf-8-sig')
-        print(f"💾 Current progress saved to: {working_file}")
+        print(f"💾 Completed results are in: {journal.journal_file} (use --export to write a CSV)")
         return False  # Signal interruption
     
     except Exception as e:
+        progress.close()
+        journal.close()
         print(f"\n❌ Error during processing {file_path.name}: {e}")
-        df.to_csv(working_file, index=False, encoding='utf-8-sig')
-        print(f"💾 Current progress saved to: {working_file}")
+        print(f"💾 Completed results are in: {journal.journal_file} (use --export to write a CSV)")
         return False  # Signal error
     
-    # Processing completed successfully
-    final_file = file_path.with_name(f"final_{file_path.stem}_bangla_output.csv")
-    df.to_csv(final_file, index=False, encoding='utf-8-sig')
-    print(f"\n🎉 Processing completed for {file_path.name}! Final output saved: {final_file}")
+    progress.close()
+    journal.close()
     
-    # Clean up progress file for this CSV
-    progress_manager.cleanup()
+    # Processing completed successfully: write the full output once
+    final_file = final_output_path(file_path, output_format)
+    write_output(df, final_file)
+    print(f"\n🎉 Processing completed for {file_path.name}! Final output saved: {final_file}")
+    return True  # Signal success
+
+def process_csv_as_worker(file_path, client_manager, worker_id, use_async=ASYNC_MODE, pack=PACK_REQUESTS,
+                          output_format=OUTPUT_FORMAT):
+    """Process leased row ranges of a CSV shared with other worker processes.
+
+    Each worker journals to its own file. When no range is free but other workers still
+    hold leases, the worker checks back until they finish, or until the earliest lease
+    expires so that the ranges of a crashed worker are picked up; a reclaimed range
+    starts from what the other workers journaled for it. Once every range is done, the
+    journals are merged into the final output.
+    """
+    journal = ResultJournal(file_path.name, worker_id=worker_id)
+
+    print(f"\n📂 Processing: {file_path.name} as worker {worker_id}")
+    print(f"📓 Result journal: {journal.journal_file}")
+
+    df = load_working_dataframe(file_path)
+    restored = replay_journals(file_path.name, df, journal.rejections)
+    if restored > 0:
+        print(f"Resuming with {restored} results restored from the journals...")
+
+    pending = build_pending_index(df)
+    print(f"🧮 Pending: {len(pending):,} cells in {len(df):,} rows")
+
+    coordinator = LeaseCoordinator(file_path, worker_id, total_rows=len(df))
+    print(f"🔒 Leases: {coordinator.lease_file}")
+
+    lease = None
+    try:
+        while True:
+            lease = coordinator.claim()
+            if lease is None:
+                if coordinator.all_done():
+                    break
+                # Other workers hold the remaining ranges: check back until they finish or the
+                # earliest lease expires, at the latest as often as leases are renewed
+                expires_at = coordinator.next_expiry() or time.time()
+                wait = min(max(expires_at - time.time(), 0) + 1, coordinator.lease_seconds / 3)
+                print(f"⏳ Worker {worker_id} waiting {wait:.0f}s for ranges leased by other workers...")
+                time.sleep(wait)
+                continue
+            start, end, reclaimed = lease
+
+            if reclaimed:
+                # The previous holder journaled results for this range after we loaded ours
+                journal.sync()
+                rows = range(start, end)
+                for cell in [cell for cell in journal.rejections if cell[0] in rows]:
+                    del journal.rejections[cell]
+                restored = replay_journals(file_path.name, df, journal.rejections, rows)
+                pending = build_pending_index(df)
+                print(f"📓 Restored {restored} results for rows {start + 1}-{end} from the journals")
+
+            # Restored outputs of the leased range are validated by the one worker holding it
+            cells = cells_for_rows(pending, start, end - 1)
+            cells = sorted(set(cells) | set(requeue_invalid_cells(
+                df, [(row, task_index) for row in range(start, end) for task_index in task_indices(df)],
+                journal, client_manager.cache
+            )))
+            print(f"\n📦 Worker {worker_id} leased rows {start + 1} to {end} ({len(cells)} cells)")
+            with coordinator.renewing(start), progress_bar(total=len(cells), desc=f"Rows {start + 1}-{end}",
+                                                   unit="cell") as progress:
+                process_rows(df, cells, client_manager, journal, progress, use_async=use_async, pack=pack)
+            journal.sync()
+            coordinator.complete(start)
+            lease = None
+
+    except KeyboardInterrupt:
+        if lease is not None:
+            coordinator.release(lease[0])
+        journal.close()
+        coordinator.close()
+        print(f"\n⏸️ Worker {worker_id} interrupted on {file_path.name}. Its range was handed back.")
+        return False  # Signal interruption
+
+    except Exception as e:
+        if lease is not None:
+            coordinator.release(lease[0])
+        journal.close()
+        coordinator.close()
+        print(f"\n❌ Error during processing {file_path.name}: {e}")
+        return False  # Signal error
+
+    journal.close()
+    coordinator.close()
+
+    # Every range is done: merge all workers' journals into one output
+    final_file = export_results(file_path, output_format)
+    print(f"\n🎉 Processing completed for {file_path.name}! Final output saved: {final_file}")
+    return True  # Signal success
+
+# ----------------- OUTPUT WRITERS -----------------
+
+# Arrow types and their Hugging Face datasets Value dtypes
+HF_DTYPES = {"string": "string", "large_string": "large_string", "int64": "int64", "int32": "int32",
+             "double": "float64", "float": "float32", "bool": "bool"}
+
+def arrow_schema(df):
+    """Arrow schema for an output DataFrame, with Hugging Face datasets features metadata.
+
+    Text columns (object or str dtype) are always strings, so a chunk whose outputs are
+    all missing still matches the rest of the file.
+    """
+    fields = []
+    for column in df.columns:
+        if pd.api.types.is_object_dtype(df[column]) or pd.api.types.is_string_dtype(df[column]):
+            fields.append(pa.field(str(column), pa.string()))
+        else:
+            fields.append(pa.Schema.from_pandas(df[[column]], preserve_index=False).field(str(column)))
+
+    features = {}
+    for field in fields:
+        dtype = HF_DTYPES.get(str(field.type))
+        if dtype is None:
+            return pa.schema(fields)  # datasets infers features from the Arrow types instead
+        features[field.name] = {"dtype": dtype, "_type": "Value"}
+    return pa.schema(fields, metadata={"huggingface": json.dumps({"info": {"features": features}})})
+
+class ParquetOutputWriter:
+    """Writes DataFrames to one Parquet file, appending a row group per write.
+
+    The schema is fixed by the first DataFrame (or passed in). The file is built as
+    a temporary file next to path and only renamed over path by close(), so readers
+    never see a file without its footer.
+    """
+
+    def __init__(self, path, schema=None, row_group_rows=PARQUET_ROW_GROUP_ROWS):
+        self.path = Path(path)
+        self.tmp_path = temp_file(self.path)
+        self.schema = schema
+        self.row_group_rows = row_group_rows
+        self.writer = None
+        self.rows = 0
+
+    def _open(self):
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.tmp_path, self.schema, compression=PARQUET_COMPRESSION)
+
+    def write(self, df):
+        if self.schema is None:
+            self.schema = arrow_schema(df)
+        self._open()
+        table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        self.writer.write_table(table, row_group_size=self.row_group_rows)
+        self.rows += len(df)
+
+    def append_file(self, path):
+        """Copy another Parquet file's row groups, one at a time."""
+        source = pq.ParquetFile(path)
+        if self.schema is None:
+            self.schema = source.schema_arrow
+        self._open()
+        for index in range(source.num_row_groups):
+            self.writer.write_table(source.read_row_group(index).cast(self.schema))
+        self.rows += source.metadata.num_rows
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.writer = None
+        atomic_replace(self.tmp_path, self.path)
+
+def write_output(df, final_file):
+    """Write a whole output DataFrame as CSV or Parquet (by suffix) via a temporary file."""
+    with metrics.timed("checkpoint_seconds_total", op="output_write"):
+        if final_file.suffix == ".parquet":
+            writer = ParquetOutputWriter(final_file)
+            writer.write(df)
+            writer.close()
+        else:
+            tmp_file = temp_file(final_file)
+            df.to_csv(tmp_file, index=False, encoding='utf-8-sig')
+            atomic_replace(tmp_file, final_file)
+
+def parquet_parts(parts_dir):
+    return sorted(Path(parts_dir).glob("part-*.parquet"))
+
+def append_parquet_part(parts_dir, chunk):
+    """Write a finished streaming chunk as the next part file of parts_dir.
+
+    Parts share the first part's schema, and each only appears under its name once
+    it is complete on disk, so a resumed run can count the rows already written.
+    """
+    parts_dir = Path(parts_dir)
+    parts_dir.mkdir(exist_ok=True)
+    parts = parquet_parts(parts_dir)
+    schema = pq.read_schema(parts[0]) if parts else None
+    with metrics.timed("checkpoint_seconds_total", op="output_write"):
+        writer = ParquetOutputWriter(parts_dir / f"part-{len(parts):05d}.parquet", schema=schema)
+        writer.write(chunk)
+        writer.close()
+
+def merge_parquet_parts(parts_dir, final_file):
+    """Combine the part files into final_file (one row group per part) and remove them."""
+    parts = parquet_parts(parts_dir)
+    writer = ParquetOutputWriter(final_file)
+    for part in parts:
+        writer.append_file(part)
+    writer.close()
+    for part in parts:
+        part.unlink()
+    Path(parts_dir).rmdir()
+
+
+# ----------------- DATASET SOURCES -----------------
+
+def parse_column_map(spec):
+    """Parse "Question=question,Response=answer" into {dataset column: TASKS input column}."""
+    column_map = {}
+    for pair in filter(None, (part.strip() for part in spec.split(","))):
+        input_column, _, dataset_column = pair.partition("=")
+        column_map[dataset_column.strip()] = input_column.strip()
+    return column_map
+
+class DatasetSource:
+    """A Hugging Face datasets source read straight from its Arrow or Parquet files.
+
+    path is a save_to_disk directory (a DatasetDict's split is picked by name), a
+    cache or download directory of .arrow/.parquet files, or one such file. Arrow
+    files are memory-mapped and Parquet files are read by row group, so chunks are
+    produced as the data is read and nothing is converted to CSV. Stands in for a
+    CSV path everywhere (name, stem, with_name, os.fspath).
+    """
+
+    def __init__(self, path, split=DATASET_SPLIT, column_map=None):
+        if pa is None:
+            raise ImportError("Reading datasets sources needs pyarrow: pip install pyarrow")
+        self.path = Path(path)
+        self.split = split
+        self.column_map = column_map or {}
+
+    name = property(lambda self: self.path.name)
+    stem = property(lambda self: self.path.stem)
+
+    def with_name(self, name):
+        return self.path.with_name(name)
+
+    def exists(self):
+        return self.path.exists()
+
+    def __fspath__(self):
+        return str(self.path)
+
+    @staticmethod
+    def is_source(path):
+        return path.is_dir() or path.suffix.lower() in (".arrow", ".parquet")
+
+    def files(self):
+        """The source's data files in row order."""
+        if self.path.is_file():
+            return [self.path]
+        directory = self.path
+        if (directory / "dataset_dict.json").exists():
+            directory = directory / self.split
+        state_file = directory / "state.json"
+        if state_file.exists():
+            with open(state_file, 'r', encoding='utf-8') as f:
+                return [directory / data_file["filename"] for data_file in json.load(f)["_data_files"]]
+
+        # Cache layouts: <name>-<split>[-00000-of-00002].arrow or <split>-00000-of-00001.parquet
+        files = sorted(
+            path for path in directory.rglob("*")
+            if path.suffix in (".arrow", ".parquet") and not path.name.startswith("cache-")
+        )
+        split_pattern = re.compile(rf"(^|[-_]){re.escape(self.split)}([-_.]|$)")
+        return [path for path in files if split_pattern.search(path.name)] or files
+
+    @staticmethod
+    def _file_batches(path):
+        """Record batches of one Arrow (stream or file format, memory-mapped) or Parquet file."""
+        if path.suffix == ".parquet":
+            yield from pq.ParquetFile(path).iter_batches()
+            return
+        source = pa.memory_map(str(path))
+        try:
+            yield from pa.ipc.open_stream(source)
+        except pa.ArrowInvalid:
+            reader = pa.ipc.open_file(source)
+            for index in range(reader.num_record_batches):
+                yield reader.get_batch(index)
+
+    @staticmethod
+    def _file_rows(path):
+        if path.suffix == ".parquet":
+            return pq.ParquetFile(path).metadata.num_rows
+        return sum(batch.num_rows for batch in DatasetSource._file_batches(path))
+
+    def schema(self):
+        path = self.files()[0]
+        if path.suffix == ".parquet":
+            return pq.read_schema(path)
+        return next(self._file_batches(path)).schema
+
+    def missing_columns(self):
+        """Source input columns of TASKS the source does not have after column mapping."""
+        columns = {self.column_map.get(name, name) for name in self.schema().names}
+        return list(dict.fromkeys(root_input_column(task) for task in TASKS if root_input_column(task) not in columns))
+
+    def count_rows(self):
+        return sum(self._file_rows(path) for path in self.files())
+
+    def iter_batches(self, start_row=0):
+        """Record batches from start_row on; earlier files and Parquet row groups are skipped unread."""
+        skip = start_row
+        for path in self.files():
+            if path.suffix == ".parquet":
+                parquet_file = pq.ParquetFile(path)
+                row_groups = list(range(parquet_file.num_row_groups))
+                while row_groups and skip >= parquet_file.metadata.row_group(row_groups[0]).num_rows:
+                    skip -= parquet_file.metadata.row_group(row_groups.pop(0)).num_rows
+                batches = parquet_file.iter_batches(row_groups=row_groups) if row_groups else []
+            else:
+                batches = self._file_batches(path)
+            for batch in batches:
+                if skip >= batch.num_rows:
+                    skip -= batch.num_rows
+                    continue
+                yield batch.slice(skip)
+                skip = 0
+
+    def _to_frame(self, table, first_row):
+        df = table.to_pandas().rename(columns=self.column_map)
+        df.index = pd.RangeIndex(first_row, first_row + len(df))
+        return prepare_output_columns(df)
+
+    def iter_chunks(self, chunk_rows=STREAM_CHUNK_ROWS, start_row=0):
+        """Yield DataFrame chunks of chunk_rows rows, indexed by global row number."""
+        pending, pending_rows, row = [], 0, start_row
+        for batch in self.iter_batches(start_row):
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            while pending_rows >= chunk_rows:
+                table = pa.Table.from_batches(pending)
+                yield self._to_frame(table.slice(0, chunk_rows), row)
+                row += chunk_rows
+                rest = table.slice(chunk_rows)
+                pending, pending_rows = rest.to_batches(), rest.num_rows
+        if pending_rows:
+            yield self._to_frame(pa.Table.from_batches(pending), row)
+
+    def to_dataframe(self):
+        """The whole source as one DataFrame (for the non-streaming modes)."""
+        batches = list(self.iter_batches())
+        if not batches:
+            return prepare_output_columns(pd.DataFrame(columns=self.schema().names).rename(columns=self.column_map))
+        return self._to_frame(pa.Table.from_batches(batches), 0)
+
+
+# ----------------- STREAMING -----------------
+
+def count_csv_rows(file_path, block_size=1 << 22):
+    """Count data rows with a quote-aware byte scan instead of a full parse.
+
+    Newlines inside quoted fields (common in Complex_CoT) are not row breaks, so a
+    newline only counts when an even number of quote characters precede it.
+    """
+    rows = 0
+    in_quotes = 0
+    last_byte = b"\n"
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            data = np.frombuffer(block, dtype=np.uint8)
+            quote_parity = (np.cumsum(data == ord('"')) + in_quotes) % 2
+            rows += int(np.count_nonzero((data == ord('\n')) & (quote_parity == 0)))
+            in_quotes = int(quote_parity[-1])
+            last_byte = block[-1:]
+    if last_byte != b"\n":
+        rows += 1  # last row without a trailing newline
+    return max(rows - 1, 0)  # minus the header
+
+def committed_csv_rows(partial_file):
+    """Rows completely appended to a streaming partial CSV, cutting off a torn last append.
+
+    append_csv_chunk keeps the rows and bytes of the last finished append in a .state
+    file; anything past those bytes was cut short by a crash. Partial files from older
+    versions have no .state and are counted as they are.
+    """
+    state_file = f"{partial_file}.state"
+    if not partial_file.exists():
+        return 0
+    if not os.path.exists(state_file):
+        return count_csv_rows(partial_file)
+    with open(state_file, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    if partial_file.stat().st_size > state["bytes"]:
+        print(f"✂️ Dropping an unfinished append from {partial_file.name}")
+        with open(partial_file, 'r+b') as f:
+            f.truncate(state["bytes"])
+    return state["rows"]
+
+def append_csv_chunk(partial_file, chunk, rows_before):
+    """Append a finished chunk to the partial CSV, fsync it and record the new committed size."""
+    state_file = f"{partial_file}.state"
+    with metrics.timed("checkpoint_seconds_total", op="output_write"):
+        if rows_before == 0:
+            write_json_atomic(state_file, {"rows": 0, "bytes": 0})
+        chunk.to_csv(partial_file, mode='w' if rows_before == 0 else 'a', header=rows_before == 0,
+                     index=False, encoding='utf-8-sig')
+        with open(partial_file, 'ab') as f:
+            os.fsync(f.fileno())
+        write_json_atomic(state_file, {"rows": rows_before + len(chunk), "bytes": partial_file.stat().st_size})
+
+def iter_csv_chunks(file_path, chunk_rows=STREAM_CHUNK_ROWS):
+    """Yield the input CSV in DataFrame chunks, indexed by global row number."""
+    for chunk in pd.read_csv(file_path, chunksize=chunk_rows):
+        yield prepare_output_columns(chunk)
+
+def iter_input_chunks(file_path, chunk_rows=STREAM_CHUNK_ROWS, start_row=0):
+    """Chunks of a CSV or dataset source; dataset sources skip rows before start_row without reading them."""
+    if isinstance(file_path, DatasetSource):
+        return file_path.iter_chunks(chunk_rows, start_row)
+    return iter_csv_chunks(file_path, chunk_rows)
+
+def count_input_rows(file_path):
+    if isinstance(file_path, DatasetSource):
+        return file_path.count_rows()
+    return count_csv_rows(file_path)
+
+def process_csv_streaming(file_path, client_manager, use_async=ASYNC_MODE, pack=PACK_REQUESTS,
+                          chunk_rows=STREAM_CHUNK_ROWS, output_format=OUTPUT_FORMAT):
+    """Process a CSV chunk by chunk, appending each finished chunk to the output.
+
+    Only one chunk and its in-flight requests are held in memory, plus the previous
+    chunk while the checkpoint writer appends it. Rows already in the partial output
+    are skipped on resume, and the journal restores finished cells of the chunks that
+    were in progress. Parquet output keeps one part file per chunk, which become the
+    row groups of the final file.
+    """
+    journal = ResultJournal(file_path.name)
+    final_file = final_output_path(file_path, output_format)
+    parquet = output_format == "parquet"
+    partial_file = final_file.with_name(final_file.name + (".parts" if parquet else ".partial"))
+
+    print(f"\n📂 Streaming: {file_path.name} ({chunk_rows} rows per chunk)")
+    print(f"📓 Result journal: {journal.journal_file}")
+
+    if parquet:
+        rows_written = sum(pq.ParquetFile(part).metadata.num_rows for part in parquet_parts(partial_file))
+    else:
+        rows_written = committed_csv_rows(partial_file)
+    journaled = journal.load_results(min_row=rows_written)
+    if rows_written or journaled:
+        print(f"Resuming after {rows_written} written rows with {len(journaled)} journaled results...")
+    else:
+        print("Starting fresh processing...")
+
+    try:
+        for chunk in iter_input_chunks(file_path, chunk_rows, start_row=rows_written):
+            if chunk.index[-1] < rows_written:
+                continue
+            chunk = chunk.loc[rows_written:].copy()
+            chunk_num = chunk.index[0] // chunk_rows + 1
+
+            for (row, column), output in journaled.items():
+                if row in chunk.index and column in chunk.columns:
+                    chunk.at[row, column] = output
+            requeue_invalid_cells(chunk, None, journal, client_manager.cache)
+
+            cells = cells_for_rows(build_pending_index(chunk), chunk.index[0], chunk.index[-1])
+            print(f"\n📦 Processing Chunk {chunk_num} "
+                  f"(rows {chunk.index[0] + 1} to {chunk.index[-1] + 1}, {len(cells)} cells)")
+            with progress_bar(total=len(cells), desc=f"Chunk {chunk_num}", unit="cell") as progress:
+                process_rows(chunk, cells, client_manager, journal, progress, use_async=use_async, pack=pack)
+            # The journal holds the chunk's results (and the previous chunk's append is done)
+            journal.sync()
+
+            # The writer thread appends the finished chunk while the next one is translated
+            if parquet:
+                checkpoints.submit(append_parquet_part, partial_file, chunk)
+            else:
+                checkpoints.submit(append_csv_chunk, partial_file, chunk, rows_written)
+            rows_written = chunk.index[-1] + 1
+            journaled = {key: value for key, value in journaled.items() if key[0] >= rows_written}
+            print(f"✅ Chunk {chunk_num} done ({rows_written:,} rows queued for {partial_file.name})")
+
+    except KeyboardInterrupt:
+        journal.close()
+        print(f"\n⏸️ Processing interrupted by user for {file_path.name}. Progress has been saved.")
+        return False  # Signal interruption
+
+    except Exception as e:
+        journal.close()
+        print(f"\n❌ Error during processing {file_path.name}: {e}")
+        return False  # Signal error
+
+    journal.close()
+    if parquet and partial_file.exists():
+        with metrics.timed("checkpoint_seconds_total", op="output_write"):
+            merge_parquet_parts(partial_file, final_file)
+    elif partial_file.exists():
+        atomic_replace(partial_file, final_file)
+        if os.path.exists(f"{partial_file}.state"):
+            os.remove(f"{partial_file}.state")
+    print(f"\n🎉 Processing completed for {file_path.name}! Final output saved: {final_file}")
     return True  # Signal success
 
-def process_multiple_csvs(csv_files, client_manager):
-    """Process multiple CSV files sequentially"""
+# ----------------- GLOBAL SCHEDULER -----------------
+
+class FileJob:
+    """Per-file state while files share one work queue."""
+
+    def __init__(self, file_path, position, output_format=OUTPUT_FORMAT, cache=None):
+        self.file_path = file_path
+        self.position = position
+        self.output_format = output_format
+        self.journal = ResultJournal(file_path.name)
+        self.df = load_working_dataframe(file_path)
+        self.restored = replay_journals(file_path.name, self.df, self.journal.rejections)
+        self.requeued = len(requeue_invalid_cells(self.df, None, self.journal, cache))
+        self.pending = build_pending_index(self.df)
+        # Cells reading another task's output are queued once that row's upstream cell is done
+        self.ready, self.waiting, blocked = split_ready_cells(self.df, cells_for_rows(self.pending, 0, len(self.df)))
+        record_blocked(blocked)
+        self.remaining = len(self.pending) - len(blocked)
+        self.finished = False
+
+    def work_units(self, pack, cells=None):
+        """Split pending cells (default: those ready to start) into (task_index, [(row, input_text), ...]) units."""
+        items_by_task = {}
+        for idx, task_index in (self.ready if cells is None else cells):
+            input_text = self.df.at[idx, TASKS[task_index]["input_column"]]
+            items_by_task.setdefault(task_index, []).append((idx, input_text))
+
+        units = []
+        for task_index, items in items_by_task.items():
+            packs = plan_packs(items) if pack else [[item] for item in items]
+            units.extend((task_index, items_in_pack) for items_in_pack in packs)
+        # Row order across tasks keeps a file's rows finishing together
+        units.sort(key=lambda unit: unit[1][0][0])
+        return units
+
+    def finalize(self):
+        """Close the journal and write the file's final output."""
+        self.journal.close()
+        final_file = final_output_path(self.file_path, self.output_format)
+        write_output(self.df, final_file)
+        self.finished = True
+        return final_file
+
+def unit_priority(order, job, unit_index):
+    """Queue priority of a work unit; lower runs first."""
+    if order == "shortest":
+        return (job.remaining, job.position, unit_index)
+    if order == "given":
+        return (job.position, unit_index)
+    # "interleave": the n-th unit of every file before the (n+1)-th of any
+    return (unit_index, job.position)
+
+async def run_global_queue(jobs, client_manager, pack=PACK_REQUESTS, order=FILE_ORDER):
+    """Feed (file, row, task) work from every file through one queue.
+
+    client_manager.max_concurrency workers pull units in priority order, so keys stay
+    busy until the very last cell of the run; each task's share of the requests in
+    flight follows its weight (see TaskSlots). Cells reading another task's output are
+    queued ahead of everything else once their row's upstream output passes validation.
+    A file is finalized (journal closed, final CSV written off the event loop) as soon
+    as its last cell completes.
+    """
+    queue = asyncio.PriorityQueue()
+    sequence = itertools.count()
+    for job in jobs:
+        for unit_index, (task_index, items) in enumerate(job.work_units(pack)):
+            queue.put_nowait((unit_priority(order, job, unit_index), next(sequence), job, task_index, items))
+
+    slots = TaskSlots(client_manager.max_concurrency)
+    progress = progress_bar(total=sum(job.remaining for job in jobs), desc="All files", unit="cell")
+    finalizers = []
+
+    def start_finalizer(job):
+        async def finalize():
+            final_file = await asyncio.to_thread(job.finalize)
+            print(f"\n🎉 Processing completed for {job.file_path.name}! Final output saved: {final_file}")
+        finalizers.append(asyncio.create_task(finalize()))
+
+    # Files with nothing pending are done right away
+    for job in jobs:
+        if job.remaining == 0:
+            start_finalizer(job)
+
+    async def worker():
+        while True:
+            _, _, job, task_index, items = await queue.get()
+            try:
+                metrics.set("queue_depth", queue.qsize())
+                task = TASKS[task_index]
+                results = await translate_pack_async(client_manager, task, items, slots.for_task(task_index))
+                for idx, output in results.items():
+                    if output:
+                        job.df.at[idx, task["output_column"]] = output
+                        job.journal.record(idx, task["output_column"], output)
+                    metrics.inc("cells_total", task=task["output_column"], status="ok" if output else "failed")
+                progress.update(len(items))
+
+                # Cells that fail validation go back to the front of the queue, one unit each, under
+                # their own task; outputs made from a rejected one wait for it like any dependent
+                done = [(idx, task_index) for idx, _ in items]
+                requeued = requeue_invalid_cells(job.df, done, job.journal, client_manager.cache)
+                new = [cell for cell in requeued if cell not in job.waiting]
+                redo, redo_waiting, redo_blocked = split_ready_cells(job.df, new)
+                job.waiting.update(redo_waiting)
+                for unit_task, unit in job.work_units(False, redo):
+                    queue.put_nowait((unit_priority(order, job, -1), next(sequence), job, unit_task, unit))
+                if new:
+                    progress.total += len(new)
+                    progress.refresh()
+                record_blocked(redo_blocked, progress)
+
+                # Dependent cells whose input just finished go to the front too
+                released, blocked = release_dependents(job.df, [cell for cell in done if cell not in requeued],
+                                                       job.waiting)
+                for unit_task, unit in job.work_units(pack, released):
+                    queue.put_nowait((unit_priority(order, job, -1), next(sequence), job, unit_task, unit))
+                record_blocked(blocked, progress)
+
+                job.remaining -= len(items) - len(new) + len(blocked) + len(redo_blocked)
+                if job.remaining == 0:
+                    start_finalizer(job)
+            finally:
+                queue.task_done()
+
+    # Released dependents refill the queue, so workers wait on it until every unit is done
+    workers = [asyncio.create_task(worker()) for _ in range(client_manager.max_concurrency)]
+    drained = asyncio.create_task(queue.join())
+    try:
+        await asyncio.wait([drained, *workers], return_when=asyncio.FIRST_COMPLETED)
+        for finished in workers:
+            if finished.done():
+                finished.result()  # a worker only stops early on an error; raise it
+        await asyncio.gather(*finalizers)
+    finally:
+        drained.cancel()
+        for pending_worker in workers:
+            pending_worker.cancel()
+        # Collect every worker's outcome; several may have stopped on the same error
+        await asyncio.gather(*workers, return_exceptions=True)
+        progress.close()
+
+def process_files_globally(csv_files, client_manager, pack=PACK_REQUESTS, order=FILE_ORDER,
+                           output_format=OUTPUT_FORMAT):
+    """Process several CSVs through one shared async work queue. Returns (completed, failed) names."""
+    jobs = []
+    for position, csv_file in enumerate(csv_files):
+        job = FileJob(csv_file, position, output_format, client_manager.cache)
+        print(f"📋 {csv_file.name}: {job.remaining:,} pending cells"
+              f"{f', {job.restored} restored from journals' if job.restored else ''}"
+              f"{f', {job.requeued} failed validation' if job.requeued else ''}")
+        jobs.append(job)
+
+    print(f"🔀 Global queue: {sum(job.remaining for job in jobs):,} cells from {len(jobs)} files, order={order}")
+    try:
+        asyncio.run(run_global_queue(jobs, client_manager, pack, order))
+    except KeyboardInterrupt:
+        print("\n⏸️ Processing interrupted by user. Progress has been saved to the result journals.")
+    except Exception as e:
+        print(f"\n❌ Error during global processing: {e}")
+    finally:
+        for job in jobs:
+            job.journal.close()
+
+    completed = [job.file_path.name for job in jobs if job.finished]
+    failed = [job.file_path.name for job in jobs if not job.finished]
+    return completed, failed
+
+def process_multiple_csvs(csv_files, client_manager, use_async=ASYNC_MODE, pack=PACK_REQUESTS,
+                          stream=STREAM_MODE, worker_id=None, order=FILE_ORDER, output_format=OUTPUT_FORMAT):
+    """Process multiple CSV files: through one shared queue in async mode, otherwise sequentially"""
     total_files = len(csv_files)
     completed_files = 0
     failed_files = []
@@ -371,12 +3502,24 @@ def process_multiple_csvs(csv_files, client_manager):
     print(f"\n🚀 Starting batch processing of {total_files} CSV files...")
     print("=" * 60)
     
+    if use_async and not stream and not worker_id:
+        completed, failed_files = process_files_globally(csv_files, client_manager, pack, order, output_format)
+        completed_files = len(completed)
+        csv_files = []  # nothing left for the sequential loop
+    
     for i, csv_file in enumerate(csv_files, 1):
         print(f"\n📋 File {i}/{total_files}: {csv_file.name}")
         print("─" * 40)
         
         try:
-            success = process_csv_in_batches(csv_file, client_manager)
+            if worker_id:
+                success = process_csv_as_worker(csv_file, client_manager, worker_id, use_async, pack,
+                                                output_format=output_format)
+            elif stream:
+                success = process_csv_streaming(csv_file, client_manager, use_async, pack,
+                                                output_format=output_format)
+            else:
+                success = process_csv_in_batches(csv_file, client_manager, use_async, pack, output_format)
             if success:
                 completed_files += 1
                 print(f"✅ Successfully completed: {csv_file.name}")
@@ -387,6 +3530,12 @@ def process_multiple_csvs(csv_files, client_manager):
         except Exception as e:
             print(f"❌ Fatal error processing {csv_file.name}: {e}")
             failed_files.append(csv_file.name)
+
+        if csv_file.name in failed_files and client_manager.exhausted():
+            # Every later file would fail the same way; the journals resume them next run
+            failed_files.extend(remaining.name for remaining in csv_files[i:])
+            print("⏸️ No API key has quota left; stopping. Rerun once the quota resets to resume.")
+            break
     
     # Final summary
     print("\n" + "=" * 60)
@@ -404,38 +3553,274 @@ def process_multiple_csvs(csv_files, client_manager):
     print(f"\n📈 API Usage Summary:")
     client_manager.print_usage_stats()
 
+# ----------------- CAPACITY PLANNER -----------------
+
+def journaled_done(csv_filename):
+    """{output column: {row: done}} from every journal of an input; the latest entry of a cell wins."""
+    done = {}
+    for journal_file in ResultJournal.journal_files(csv_filename):
+        journal = ResultJournal(csv_filename)
+        journal.journal_file = journal_file
+        for entry in journal.entries():
+            done.setdefault(entry["column"], {})[entry["row"]] = bool(entry["output"])
+    return done
+
+def scan_pending(file_path, cache, seen, stats):
+    """Add one input's pending cells to stats[task output column], reading it chunk by chunk.
+
+    Cells done in the input or any journal are skipped. Pending inputs found in the
+    translation cache, or already seen in this plan (the run asks for them once),
+    cost no request. A dependent cell whose input is still to be generated is sized
+    like the upstream cell's input.
+    """
+    done_by_column = {column: pd.Series(rows, dtype=bool) for column, rows in journaled_done(file_path.name).items()}
+    for chunk_number, chunk in enumerate(iter_input_chunks(file_path, STREAM_CHUNK_ROWS)):
+        pending_masks, input_lengths = {}, {}
+        for task_index in task_indices(chunk):
+            task = TASKS[task_index]
+            column = task["output_column"]
+            outputs = chunk[column]
+            done = (outputs.notna() & (outputs.astype(str) != "")).to_numpy()
+            if column in done_by_column:
+                journaled = done_by_column[column].reindex(chunk.index)
+                done = np.where(journaled.notna().to_numpy(), journaled.fillna(False).to_numpy(dtype=bool), done)
+            inputs = chunk[task["input_column"]]
+            has_input = (inputs.notna() & (inputs.astype(str).str.strip() != "")).to_numpy()
+            lengths = inputs.fillna("").astype(str).str.len().to_numpy()
+            upcoming = np.zeros(len(chunk), dtype=bool)
+            if task["upstream"] in pending_masks:
+                upcoming = pending_masks[task["upstream"]] & ~has_input
+                lengths = np.where(upcoming, input_lengths[task["upstream"]], lengths)
+            pending_masks[task_index] = ~done & (has_input | upcoming)
+            input_lengths[task_index] = lengths
+            texts = inputs[~done & has_input].astype(str)
+
+            task_stats = stats[column]
+            task_stats["inputs"] += chunk_number == 0
+            pending = len(texts) + int(np.count_nonzero(~done & upcoming))
+            task_stats["pending"] += pending
+            if not pending:
+                continue
+            keys = [TranslationCache.make_key(task["model"], task["prompt_template"], text) for text in texts]
+            cached = cache.contains(keys) if cache is not None else set()
+            fresh = np.array([key not in cached and key not in seen for key in keys], dtype=bool)
+            # Duplicates within the plan: only the first occurrence is requested
+            first = ~pd.Series(keys, dtype=object).duplicated().to_numpy()
+            task_stats["cached"] += int(np.count_nonzero([key in cached for key in keys]))
+            seen.update(keys)
+
+            lengths = np.concatenate([texts.str.len().to_numpy(dtype=np.int64)[fresh & first],
+                                      lengths[~done & upcoming].astype(np.int64)])
+            task_stats["requested"] += len(lengths)
+            task_stats["input_chars"] += int(lengths.sum())
+            if SEGMENT_LONG_FORM and task.get("long_form", False):
+                segments = np.where(lengths > SEGMENT_MAX_CHARS, np.ceil(lengths / SEGMENT_MAX_CHARS), 1)
+            else:
+                segments = np.ones(len(lengths))
+            packable = (lengths <= PACK_ITEM_MAX_CHARS) & (segments == 1)
+            task_stats["single_requests"] += int(segments[~packable].sum())
+            task_stats["packable"] += int(np.count_nonzero(packable))
+            task_stats["packable_chars"] += int(lengths[packable].sum())
+
+def measured_latencies(metrics_file=METRICS_FILE):
+    """{task label: mean request latency} from a previous run's metrics snapshot, if there is one."""
+    if not metrics_file or not os.path.exists(metrics_file):
+        return {}
+    try:
+        with open(metrics_file, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+    return {
+        h["labels"]["task"]: h["sum"] / h["count"]
+        for h in snapshot.get("histograms", [])
+        if h["name"] == "request_latency_seconds" and h["count"] >= LATENCY_MIN_SAMPLES
+    }
+
+def plan_run(csv_files, use_async=ASYNC_MODE, pack=PACK_REQUESTS, max_concurrency=MAX_CONCURRENCY,
+             per_key_limit=PER_KEY_CONCURRENCY, cache=None):
+    """Print the requests, tokens, cost and time a run over csv_files would take, without API calls."""
+    stats = {task["output_column"]: Counter() for task in TASKS}
+    seen = set()
+    print(f"\n🧮 Planning {len(csv_files)} input(s), no API calls...")
+    for file_path in csv_files:
+        before = sum(task_stats["pending"] for task_stats in stats.values())
+        scan_pending(file_path, cache, seen, stats)
+        print(f"  {file_path.name}: {sum(task_stats['pending'] for task_stats in stats.values()) - before:,} "
+              f"pending cells")
+
+    latencies = measured_latencies()
+    concurrency = (max_concurrency or len(API_KEYS) * per_key_limit) if use_async else 1
+    total_requests = total_input = total_output = busy_seconds = 0
+    print(f"\n{'Task':<20}{'pending':>10}{'cached':>10}{'requests':>11}{'in tokens':>13}{'out tokens':>13}"
+          f"{'latency':>9}")
+    for task in TASKS:
+        column = task["output_column"]
+        task_stats = stats[column]
+        if not task_stats["inputs"]:
+            continue  # no input has this task's column
+        packed = 0
+        if pack and task_stats["packable"]:
+            packed = max(math.ceil(task_stats["packable"] / PACK_MAX_ITEMS),
+                         math.ceil(task_stats["packable_chars"] / PACK_MAX_CHARS))
+        requests = task_stats["single_requests"] + (packed if pack else task_stats["packable"])
+        # A template sent inline carries its instructions in every prompt just the same
+        instructions = split_prompt(task["prompt_template"])[0] or task["prompt_template"].replace("{}", "")
+        payload_tokens = task_stats["input_chars"] / PLAN_CHARS_PER_TOKEN
+        input_tokens = int(payload_tokens + requests * len(instructions) / PLAN_BANGLA_CHARS_PER_TOKEN)
+        output_tokens = int(payload_tokens * PLAN_OUTPUT_TOKEN_RATIO)
+        latency = latencies.get(column, PLAN_LATENCY_SECONDS)
+        measured = "" if column in latencies else "*"
+        print(f"{column:<20}{task_stats['pending']:>10,}{task_stats['cached']:>10,}{requests:>11,}"
+              f"{input_tokens:>13,}{output_tokens:>13,}{latency:>8.1f}s{measured}")
+        total_requests += requests
+        total_input += input_tokens
+        total_output += output_tokens
+        busy_seconds += requests * latency
+    if any(task["output_column"] not in latencies for task in TASKS):
+        print(f"* assumed latency (PLAN_LATENCY_SECONDS); no measured {METRICS_FILE or 'metrics'} from an earlier run")
+
+    keys = len(API_KEYS)
+    scheduler = KeyPoolScheduler(API_KEYS, [f"KEY_{i + 1}" for i in range(keys)])
+    daily_capacity = keys * REQUESTS_PER_DAY_PER_KEY
+    left_today = sum(max(0, REQUESTS_PER_DAY_PER_KEY - used) for used in scheduler.requests_today)
+    # Throughput is bounded by both the in-flight requests and the per-minute quotas
+    rate = min(concurrency / max(busy_seconds / max(total_requests, 1), 1e-9),
+               keys * REQUESTS_PER_MINUTE_PER_KEY / 60)
+    active_seconds = total_requests / rate if total_requests else 0
+
+    print(f"\n📨 {total_requests:,} requests | {total_input:,} input + {total_output:,} output tokens")
+    if PLAN_PRICE_INPUT_PER_M or PLAN_PRICE_OUTPUT_PER_M:
+        cost = total_input / 1e6 * PLAN_PRICE_INPUT_PER_M + total_output / 1e6 * PLAN_PRICE_OUTPUT_PER_M
+        print(f"💵 About ${cost:,.2f} at paid-tier prices (free-tier keys cost nothing but are capped per day)")
+    print(f"🔑 {keys} keys x {REQUESTS_PER_DAY_PER_KEY}/day = {daily_capacity:,} requests/day "
+          f"({left_today:,} left today), {keys * REQUESTS_PER_MINUTE_PER_KEY:,}/min | "
+          f"{concurrency} in flight{' (async)' if use_async else ' (sync)'}")
+    print(f"⏱️ {active_seconds / 3600:.1f} h of request time at {rate * 60:.0f} requests/min")
+
+    if total_requests <= left_today:
+        finish = datetime.now() + timedelta(seconds=active_seconds)
+        print(f"📅 Fits in today's remaining quota; done around {finish:%Y-%m-%d %H:%M}")
+        return
+    if not daily_capacity:
+        print("📅 No daily quota configured; the run cannot finish")
+        return
+    more_days = math.ceil((total_requests - left_today) / daily_capacity)
+    last_day_requests = total_requests - left_today - (more_days - 1) * daily_capacity
+    finish = (datetime.now() + timedelta(seconds=scheduler._seconds_until_reset() + (more_days - 1) * 86400
+                                         + last_day_requests / rate))
+    print(f"📅 Needs {more_days + 1} quota days (daily quotas reset at midnight Pacific); "
+          f"done around {finish:%Y-%m-%d %H:%M}")
+    print(f"💡 One quota day would take {math.ceil(total_requests / REQUESTS_PER_DAY_PER_KEY):,} keys "
+          f"at {REQUESTS_PER_DAY_PER_KEY}/day")
+
 # ----------------- ENTRY POINT -----------------
 
+def parse_cli_args(argv):
+    """Split argv into file arguments and --options (``--flag`` or ``--name=value``)."""
+    file_args = []
+    options = {}
+    for arg in argv:
+        if arg.startswith("--"):
+            name, _, value = arg[2:].partition("=")
+            options[name] = value if value else True
+        else:
+            file_args.append(arg)
+    return file_args, options
+
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python script.py <csv_file1> [csv_file2] [csv_file3] ...")
+    global TASKS
+    file_args, options = parse_cli_args(sys.argv[1:])
+
+    if not file_args:
+        print("Usage: python script.py [options] <csv_file1> [csv_file2] [csv_file3] ...")
         print("Example: python script.py medical-o1-reasoning-SFT.csv another_dataset.csv")
         print("Example: python script.py *.csv  # Process all CSV files in current directory")
+        print("Example: python script.py medical_dataset/  # A datasets save_to_disk directory, streamed")
+        print("\nOptions:")
+        print("  --async                 Keep several requests in flight (asyncio client)")
+        print("  --concurrency=N         Max requests in flight across all keys (default: keys x per-key)")
+        print("  --fixed-concurrency     Keep --concurrency requests in flight instead of adapting (AIMD)")
+        print("  --per-key=N             Max requests in flight per key (default: PER_KEY_CONCURRENCY)")
+        print("  --no-cache              Skip the persistent translation cache (CACHE_FILE)")
+        print("  --export                Write final outputs from the result journals, no API calls")
+        print("  --plan                  Estimate pending cells, requests, tokens, cost and days to finish, no API calls")
+        print("  --format=FORMAT         Final output format: csv (default) or parquet (Dataset.from_parquet ready)")
+        print("  --tasks=FILE            JSON task list added to the built-in tasks (default: TASKS_FILE if present)")
+        print("  --columns=MAP           Dataset column for each TASKS input, e.g. Question=question,Response=answer")
+        print("  --split=SPLIT           Split to read from a saved DatasetDict or cache directory (default: train)")
+        print("  --prompt-mode=MODE      Task instructions as system (default), cached (context cache) or inline")
+        print("  --pack                  Pack several short inputs into one request (implies --async)")
+        print("  --stream                Read, process and write inputs in chunks (STREAM_CHUNK_ROWS)")
+        print("  --worker[=NAME]         Share the input with other workers through leased row ranges")
+        print("  --order=ORDER           Async multi-file queue order: interleave, shortest or given")
+        print("  --quiet                 No per-request lines or progress bars; status line every METRICS_FLUSH_SECONDS")
         print("\nAPI Key Management:")
         print("- Modify the .env file to set which API keys this terminal should use")
         print("- Each terminal can have different API keys by using different .env files")
         print("- The script will rotate through all keys specified in API_KEYS")
         return
 
-    # Collect all CSV files
+    # Tasks from --tasks or TASKS_FILE are added to the built-in medical tasks
+    tasks_option = options.get("tasks")
+    tasks_file = Path(__file__).parent / (tasks_option if isinstance(tasks_option, str) else TASKS_FILE)
+    if tasks_option or tasks_file.exists():
+        try:
+            TASKS = load_tasks(tasks_file)
+        except (OSError, ValueError) as e:
+            print(f"❌ Could not load tasks from {tasks_file}: {e}")
+            return
+        print(f"🧾 Loaded {len(TASKS)} tasks (built-in plus {tasks_file.name})")
+
+    # Collect all CSV files and datasets sources
     csv_files = []
-    for arg in sys.argv[1:]:
+    column_map = parse_column_map(options.get("columns", DATASET_COLUMNS))
+    for arg in file_args:
         file_path = Path(__file__).parent / arg
         if file_path.exists() and file_path.suffix.lower() == '.csv':
             csv_files.append(file_path)
+        elif file_path.exists() and DatasetSource.is_source(file_path):
+            try:
+                source = DatasetSource(file_path, split=options.get("split", DATASET_SPLIT), column_map=column_map)
+                missing = source.missing_columns()
+            except Exception as e:
+                print(f"⚠️ Skipping unreadable dataset {arg}: {e}")
+                continue
+            # A dataset only runs the tasks whose input it has; it is skipped when no task applies
+            if set(missing) >= {root_input_column(task) for task in TASKS}:
+                print(f"⚠️ Skipping dataset {arg}: no column for {', '.join(missing)} (map them with --columns)")
+                continue
+            csv_files.append(source)
         else:
-            print(f"⚠️ Skipping non-existent or non-CSV file: {arg}")
+            print(f"⚠️ Skipping non-existent or unsupported input: {arg}")
     
     if not csv_files:
-        print("❌ No valid CSV files found!")
+        print("❌ No valid CSV files or datasets found!")
+        return
+
+    output_format = options.get("format", OUTPUT_FORMAT)
+    if output_format not in ("csv", "parquet"):
+        print(f"❌ Unknown output format: {output_format} (use csv or parquet)")
+        return
+    if output_format == "parquet" and pa is None:
+        print("❌ Parquet output needs pyarrow: pip install pyarrow")
+        return
+
+    prompt_mode = options.get("prompt-mode", PROMPT_MODE)
+    if prompt_mode not in ("system", "cached", "inline"):
+        print(f"❌ Unknown prompt mode: {prompt_mode} (use system, cached or inline)")
+        return
+
+    if options.get("export"):
+        for csv_file in csv_files:
+            export_results(csv_file, output_format)
         return
 
-    print(f"📂 Found {len(csv_files)} CSV file(s) to process:")
+    print(f"📂 Found {len(csv_files)} input(s) to process:")
     for i, csv_file in enumerate(csv_files, 1):
-        # Load to check row count
+        # Count rows with a byte scan (or dataset metadata); parsing the whole input here would be wasted work
         try:
-            df = pd.read_csv(csv_file)
-            row_count = len(df)
+            row_count = count_input_rows(csv_file)
             print(f"  {i}. {csv_file.name} ({row_count:,} rows)")
         except Exception as e:
             print(f"  {i}. {csv_file.name} (⚠️ Error reading: {e})")
@@ -443,8 +3828,32 @@ def main():
     print(f"\n📊 Batch size: {BATCH_SIZE} rows")
     print(f"🔑 Available API keys: {len(API_KEYS)}")
     print(f"🌏 Target language: Bangla")
-    print(f"📝 Columns to translate: Question, Complex_CoT, Response")
+    print(f"📝 Tasks: {', '.join(task['input_column'] + ' → ' + task['output_column'] for task in TASKS)}")
+
+    pack = PACK_REQUESTS or bool(options.get("pack"))
+    # Packing groups cells across rows, which only the async engine does
+    use_async = ASYNC_MODE or bool(options.get("async")) or pack
+    if use_async:
+        print("⚡ Execution mode: async")
+    stream = STREAM_MODE or bool(options.get("stream"))
+    if not stream and not options.get("worker") and any(isinstance(f, DatasetSource) for f in csv_files):
+        # Translation starts with the first batch instead of after loading the whole dataset
+        stream = True
+    if stream:
+        print(f"🌊 Streaming input in chunks of {STREAM_CHUNK_ROWS} rows")
+    worker_id = options.get("worker")
+    if worker_id is True:
+        worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    if worker_id:
+        print(f"👷 Worker mode as {worker_id}: claiming {LEASE_RANGE_ROWS}-row leases")
     
+    if options.get("plan"):
+        # Read the cache without creating one
+        use_cache = USE_CACHE and not options.get("no-cache") and os.path.exists(CACHE_FILE)
+        plan_run(csv_files, use_async, pack, int(options.get("concurrency", MAX_CONCURRENCY)),
+                 int(options.get("per-key", PER_KEY_CONCURRENCY)), TranslationCache() if use_cache else None)
+        return
+
     # Ask for confirmation if multiple files
     if len(csv_files) > 1:
         response = input(f"\nProceed with processing {len(csv_files)} files? (y/N): ").strip().lower()
@@ -452,18 +3861,49 @@ def main():
             print("Processing cancelled.")
             return
 
+    # kill (SIGTERM) stops the run like Ctrl+C: queued checkpoints are written and journals closed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    if options.get("quiet"):
+        metrics.quiet = True
+    print(f"📊 Metrics: {METRICS_FILE or '-'} / {METRICS_PROM_FILE or '-'} every {METRICS_FLUSH_SECONDS:.0f}s, "
+          f"events → {METRICS_EVENTS_FILE or '-'}{' (quiet mode)' if metrics.quiet else ''}")
+    metrics.start()
+
     try:
-        client_manager = GenAIClientManager(API_KEYS)
+        client_manager = GenAIClientManager(
+            API_KEYS,
+            max_concurrency=int(options.get("concurrency", MAX_CONCURRENCY)),
+            adaptive=ADAPTIVE_CONCURRENCY and not options.get("fixed-concurrency"),
+            per_key_limit=int(options.get("per-key", PER_KEY_CONCURRENCY)),
+            cache=TranslationCache() if USE_CACHE and not options.get("no-cache") else None,
+            prompt_mode=prompt_mode
+        )
         
         if len(csv_files) == 1:
             # Single file processing
-            process_csv_in_batches(csv_files[0], client_manager)
+            if worker_id:
+                process_csv_as_worker(csv_files[0], client_manager, worker_id, use_async, pack,
+                                      output_format=output_format)
+            elif stream:
+                process_csv_streaming(csv_files[0], client_manager, use_async, pack, output_format=output_format)
+            else:
+                process_csv_in_batches(csv_files[0], client_manager, use_async, pack, output_format)
+            client_manager.print_usage_stats()
         else:
             # Multiple file processing
-            process_multiple_csvs(csv_files, client_manager)
+            process_multiple_csvs(csv_files, client_manager, use_async, pack, stream, worker_id,
+                                  order=options.get("order", FILE_ORDER), output_format=output_format)
             
     except Exception as e:
         print(f"❌ Fatal error: {e}")
+    finally:
+        try:
+            checkpoints.flush()
+        except Exception as e:
+            print(f"❌ {e}")
+        metrics.stop()
+        print(metrics.status_line())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+
+# Benchmark the translation pipeline in a.py against the in-process fake Gemini
+# server, without spending real quota.
+#
+# Example: python benchmark.py --rows 1000 10000 --mode async --concurrency 16
+#          python benchmark.py --rows 5000 --files 4 --rate-limit-prob 0.02 --json bench.json
+
+
+# ----------------- SYNTHETIC DATA -----------------
+
+WORDS = ("patient fever chronic diagnosis treatment symptom blood pressure cardiac renal "
+         "infection therapy dose clinical acute history examination likely because therefore").split()
+
+def synthetic_text(rng, mean_words):
+    n_words = max(1, int(rng.expovariate(1 / mean_words)))
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+def write_synthetic_csv(path, rows, seed):
+    """A medical-o1 shaped CSV: short Question, long Complex_CoT, medium Response."""
+    rng = random.Random(seed)
+    pd.DataFrame({
+        "Question": [synthetic_text(rng, 40) for _ in range(rows)],
+        "Complex_CoT": [synthetic_text(rng, 350) for _ in range(rows)],
+        "Response": [synthetic_text(rng, 120) for _ in range(rows)],
+    }).to_csv(path, index=False, encoding='utf-8-sig')
+
+
+# ----------------- MEASUREMENT -----------------
+
+class Timer:
+    """Accumulates time spent inside wrapped functions (with main_thread_only, by the main thread)."""
+
+    def __init__(self, main_thread_only=False):
+        self.seconds = 0.0
+        self.main_thread_only = main_thread_only
+
+    def wrap(self, func):
+        def wrapped(*args, **kwargs):
+            if self.main_thread_only and threading.current_thread() is not threading.main_thread():
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds += time.perf_counter() - start
+        return wrapped
+
+    def wrap_async(self, func):
+        async def wrapped(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.seconds += time.perf_counter() - start
+        return wrapped
+
+
+def run_scenario(config):
+    """Run one benchmark scenario in the current process and return its metrics."""
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    os.chdir(workdir)
+
+    # a.py reads its configuration from the environment at import time
+    os.environ["API_KEYS"] = ",".join(f"fake-key-{i}" for i in range(config["keys"]))
+    os.environ["REQUESTS_PER_MINUTE_PER_KEY"] = str(config["rpm"] or 10**9)
+    os.environ["REQUESTS_PER_DAY_PER_KEY"] = str(config["rpd"] or 10**9)
+    os.environ["QUOTA_STATE_FILE"] = os.path.join(workdir, "key_quota_state.json")
+    os.environ["CACHE_FILE"] = os.path.join(workdir, "translation_cache.sqlite3")
+    os.environ["TQDM_DISABLE"] = "1"
+    os.environ["OUTPUT_FORMAT"] = config["format"]
+    os.environ["PROMPT_MODE"] = config["prompt_mode"]
+    os.environ["HEDGE_REQUESTS"] = "1" if config["hedge"] else "0"
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+    import fake_genai
+    import a
+
+    server = fake_genai.FakeGeminiServer(
+        latency_median=config["latency_median"], latency_sigma=config["latency_sigma"],
+        latency_per_1k_chars=config["latency_per_1k_chars"],
+        rpm_per_key=config["rpm"], rpd_per_key=config["rpd"],
+        rate_limit_prob=config["rate_limit_prob"], server_error_prob=config["server_error_prob"],
+        retry_delay=config["retry_delay"], stall_prob=config["stall_prob"], stall_seconds=config["stall_seconds"],
+        truncate_prob=config["truncate_prob"], echo_prob=config["echo_prob"],
+        min_cache_tokens=config["min_cache_tokens"], seed=config["seed"]
+    )
+    a.genai.Client = server.client_factory()
+
+    # Sleeps the pipeline itself does (fixed delays, backoff) are wasted time
+    sleep_timer = Timer()
+    time.sleep = sleep_timer.wrap(time.sleep)
+    asyncio.sleep = sleep_timer.wrap_async(asyncio.sleep)
+
+    # Checkpoint I/O the pipeline waits for: journal writes/fsyncs and output writes.
+    # Writes done by the background checkpoint writer do not hold up requests.
+    checkpoint_timer = Timer(main_thread_only=True)
+    a.ResultJournal.record = checkpoint_timer.wrap(a.ResultJournal.record)
+    a.ResultJournal.sync = checkpoint_timer.wrap(a.ResultJournal.sync)
+    pd.DataFrame.to_csv = checkpoint_timer.wrap(pd.DataFrame.to_csv)
+    a.ParquetOutputWriter.write = checkpoint_timer.wrap(a.ParquetOutputWriter.write)
+    a.ParquetOutputWriter.close = checkpoint_timer.wrap(a.ParquetOutputWriter.close)
+
+    csv_files = []
+    rows_per_file = config["rows"] // config["files"]
+    for i in range(config["files"]):
+        path = Path(workdir) / f"bench_{i + 1}.csv"
+        write_synthetic_csv(path, rows_per_file, config["seed"] + i)
+        csv_files.append(path)
+    total_rows = rows_per_file * config["files"]
+
+    cache = a.TranslationCache() if config["cache"] else None
+    use_async = config["mode"] == "async"
+    log = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        client_manager = a.GenAIClientManager(
+            a.API_KEYS, max_concurrency=config["concurrency"], per_key_limit=config["per_key"], cache=cache,
+            adaptive=not config["fixed"]
+        )
+        if len(csv_files) == 1:
+            a.process_csv_in_batches(csv_files[0], client_manager, use_async, config["pack"])
+        else:
+            a.process_multiple_csvs(csv_files, client_manager, use_async, config["pack"])
+    wall = time.perf_counter() - start
+
+    failed_cells = 0
+    invalid_cells = 0
+    for path in csv_files:
+        output = a.final_output_path(path)
+        if output.exists():
+            df = pd.read_parquet(output) if output.suffix == ".parquet" else pd.read_csv(output)
+            failed_cells += int(sum(df[task["output_column"]].isna().sum() for task in a.TASKS))
+            invalid_cells += int(sum(a.validate_outputs(df, task).any(axis=1).sum() for task in a.TASKS))
+        else:
+            failed_cells += rows_per_file * len(a.TASKS)
+
+    return {
+        "rows": total_rows,
+        "files": config["files"],
+        "mode": config["mode"] + ("+pack" if config["pack"] else ""),
+        "concurrency": config["concurrency"] if use_async else 1,
+        "final_window": client_manager.controller.window if use_async and client_manager.controller else None,
+        "wall_s": round(wall, 3),
+        "rows_per_s": round(total_rows / wall, 2) if wall else None,
+        "requests_per_row": round(server.stats["requests"] / total_rows, 3) if total_rows else None,
+        "input_tokens_per_row": round(server.stats["input_tokens"] / total_rows, 1) if total_rows else None,
+        "cached_tokens_per_row": round(server.stats["cached_tokens"] / total_rows, 1) if total_rows else None,
+        "checkpoint_s": round(checkpoint_timer.seconds, 3),
+        "checkpoint_pct": round(checkpoint_timer.seconds / wall * 100, 2) if wall else None,
+        "sleep_s": round(sleep_timer.seconds, 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "failed_cells": failed_cells,
+        "invalid_cells": invalid_cells,
+        "rejected_outputs": int(a.metrics.total("invalid_outputs_total")),
+        "server": dict(server.stats),
+    }
+
+
+def _run_child(config, queue):
+    try:
+        queue.put(run_scenario(config))
+    except Exception as e:
+        queue.put({"rows": config["rows"], "error": repr(e)})
+
+
+def run_isolated(config):
+    """Run a scenario in a fresh process so peak RSS is measured per scenario."""
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_child, args=(config, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+# ----------------- ENTRY POINT -----------------
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Throughput benchmark for a.py against a fake Gemini server")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000], help="synthetic rows per scenario")
+    parser.add_argument("--files", type=int, default=1, help="split each scenario's rows across this many CSVs")
+    parser.add_argument("--mode", choices=["sync", "async"], default="async")
+    parser.add_argument("--pack", action="store_true", help="enable request packing")
+    parser.add_argument("--cache", action="store_true", help="enable the translation cache")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv", help="final output format")
+    parser.add_argument("--prompt-mode", choices=["system", "cached", "inline"], default="system",
+                        help="how task instructions are sent (PROMPT_MODE)")
+    parser.add_argument("--min-cache-tokens", type=int, default=1024, help="smallest context cache the server accepts")
+    parser.add_argument("--keys", type=int, default=29)
+    parser.add_argument("--concurrency", type=int, default=16, help="max requests in flight")
+    parser.add_argument("--fixed", action="store_true", help="fixed concurrency instead of the adaptive window")
+    parser.add_argument("--per-key", type=int, default=2)
+    parser.add_argument("--latency-median", type=float, default=0.05, help="seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="lognormal sigma")
+    parser.add_argument("--latency-per-1k-chars", type=float, default=0.0, help="extra seconds per 1000 prompt chars")
+    parser.add_argument("--rpm", type=int, default=None, help="per-key requests per minute (default: unlimited)")
+    parser.add_argument("--rpd", type=int, default=None, help="per-key requests per day (default: unlimited)")
+    parser.add_argument("--rate-limit-prob", type=float, default=0.0, help="chance of a random 429")
+    parser.add_argument("--server-error-prob", type=float, default=0.0, help="chance of a 503")
+    parser.add_argument("--stall-prob", type=float, default=0.0, help="chance a request hangs")
+    parser.add_argument("--stall-seconds", type=float, default=30.0, help="how long a hung request takes")
+    parser.add_argument("--hedge", action="store_true", help="duplicate slow requests on another key (HEDGE_REQUESTS)")
+    parser.add_argument("--truncate-prob", type=float, default=0.0, help="chance an answer is cut short")
+    parser.add_argument("--echo-prob", type=float, default=0.0, help="chance an answer echoes the English input")
+    parser.add_argument("--retry-delay", type=float, default=1.0, help="RetryInfo delay on 429s, seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write results to this JSON file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = []
+    for rows in args.rows:
+        config = {
+            "rows": rows, "files": args.files, "mode": args.mode, "pack": args.pack, "cache": args.cache,
+            "format": args.format, "prompt_mode": args.prompt_mode, "min_cache_tokens": args.min_cache_tokens,
+            "keys": args.keys, "concurrency": args.concurrency, "fixed": args.fixed, "per_key": args.per_key,
+            "latency_median": args.latency_median, "latency_sigma": args.latency_sigma,
+            "latency_per_1k_chars": args.latency_per_1k_chars,
+            "rpm": args.rpm, "rpd": args.rpd, "rate_limit_prob": args.rate_limit_prob,
+            "server_error_prob": args.server_error_prob, "retry_delay": args.retry_delay,
+            "stall_prob": args.stall_prob, "stall_seconds": args.stall_seconds, "hedge": args.hedge,
+            "truncate_prob": args.truncate_prob, "echo_prob": args.echo_prob, "seed": args.seed,
+        }
+        print(f"⏱️ Running {rows:,} rows ({args.mode}{'+pack' if args.pack else ''}, {args.prompt_mode} prompts)...")
+        result = run_isolated(config)
+        results.append(result)
+        if "error" in result:
+            print(f"❌ {result['error']}")
+            continue
+        print(f"  {result['rows_per_s']} rows/s | {result['requests_per_row']} requests/row | "
+              f"{result['input_tokens_per_row']} input tokens/row ({result['cached_tokens_per_row']} cached) | "
+              f"checkpoint {result['checkpoint_s']}s ({result['checkpoint_pct']}%) | "
+              f"sleeping {result['sleep_s']}s | peak RSS {result['peak_rss_mb']} MB | "
+              f"failed cells {result['failed_cells']} | invalid cells {result['invalid_cells']} "
+              f"({result['rejected_outputs']} rejected) | final window {result['final_window']} | "
+              f"server {result['server']}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Results saved to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import asyncio
+import json
+import math
+import random
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+from google.genai import errors
+
+# Keep references to the real sleeps: the benchmark wraps time.sleep/asyncio.sleep to
+# measure how long the pipeline itself sleeps, and simulated latency must not count.
+_real_sleep = time.sleep
+_real_async_sleep = asyncio.sleep
+
+BANGLA_FILLER = "এটি একটি পরীক্ষামূলক বাংলা অনুবাদ যা নকল সার্ভার থেকে এসেছে। "
+
+
+# ----------------- FAKE GEMINI SERVER -----------------
+
+class FakeGeminiServer:
+    """In-process stand-in for the Gemini API used by a.py.
+
+    Simulates a lognormal latency distribution (plus latency_per_1k_chars for every
+    thousand prompt characters, as generation time grows with output length), per-key per-minute and per-day
+    quotas (429 RESOURCE_EXHAUSTED with RetryInfo / QuotaFailure details, like the
+    real API), random 429s, random 5xx errors, stalled requests that take
+    stall_seconds to answer, like a hung socket, truncated answers that stop
+    early with finish_reason MAX_TOKENS, and answers that just echo the English
+    input. system_instruction and context caches (caches.create, per key, with
+    a minimum size of min_cache_tokens) are counted in usage_metadata like the
+    real API does, so token savings can be measured. Hand client_factory() to
+    a.py in place of genai.Client.
+    """
+
+    def __init__(self, latency_median=0.05, latency_sigma=0.5, latency_per_1k_chars=0.0, rpm_per_key=None, rpd_per_key=None,
+                 rate_limit_prob=0.0, server_error_prob=0.0, retry_delay=1.0, stall_prob=0.0, stall_seconds=30.0,
+                 truncate_prob=0.0, echo_prob=0.0, system_instruction_supported=True, min_cache_tokens=1024,
+                 output_ratio=1.1, seed=0):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.latency_per_1k_chars = latency_per_1k_chars
+        self.rpm_per_key = rpm_per_key
+        self.rpd_per_key = rpd_per_key
+        self.rate_limit_prob = rate_limit_prob
+        self.server_error_prob = server_error_prob
+        self.retry_delay = retry_delay
+        self.stall_prob = stall_prob
+        self.stall_seconds = stall_seconds
+        self.truncate_prob = truncate_prob
+        self.echo_prob = echo_prob
+        self.system_instruction_supported = system_instruction_supported
+        self.min_cache_tokens = min_cache_tokens
+        self.output_ratio = output_ratio
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.minute_windows = {}
+        self.day_counts = {}
+        self.caches = {}  # name -> (api_key, token count)
+        self.stats = {"requests": 0, "ok": 0, "rate_limited": 0, "daily_exhausted": 0, "server_errors": 0, "stalled": 0, "truncated": 0, "echoed": 0,
+                      "input_tokens": 0, "cached_tokens": 0}
+
+    def client_factory(self):
+        return lambda api_key, **kwargs: FakeClient(self, api_key)
+
+    # ----- request handling -----
+
+    def _latency(self, contents):
+        with self.lock:
+            if self.random.random() < self.stall_prob:
+                self.stats["stalled"] += 1
+                return self.stall_seconds
+            length_latency = len(str(contents)) / 1000 * self.latency_per_1k_chars
+            return self.random.lognormvariate(math.log(self.latency_median), self.latency_sigma) + length_latency
+
+    def _admit(self, api_key):
+        """Count the request against the key's quotas; raise the error the real API would."""
+        now = time.time()
+        with self.lock:
+            self.stats["requests"] += 1
+            window = self.minute_windows.setdefault(api_key, deque())
+            while window and now - window[0] >= 60:
+                window.popleft()
+
+            if self.rpd_per_key is not None and self.day_counts.get(api_key, 0) >= self.rpd_per_key:
+                self.stats["daily_exhausted"] += 1
+                raise rate_limit_error(self.retry_delay, daily_quota=self.rpd_per_key)
+            if self.rpm_per_key is not None and len(window) >= self.rpm_per_key:
+                self.stats["rate_limited"] += 1
+                raise rate_limit_error(max(1.0, 60 - (now - window[0])))
+            if self.random.random() < self.rate_limit_prob:
+                self.stats["rate_limited"] += 1
+                raise rate_limit_error(self.retry_delay)
+            if self.random.random() < self.server_error_prob:
+                self.stats["server_errors"] += 1
+                raise errors.ServerError(503, {"error": {
+                    "code": 503, "status": "UNAVAILABLE", "message": "The model is overloaded."
+                }})
+
+            window.append(now)
+            self.day_counts[api_key] = self.day_counts.get(api_key, 0) + 1
+            self.stats["ok"] += 1
+
+    def create_cache(self, api_key, config):
+        tokens = count_tokens(getattr(config, "system_instruction", None) or "")
+        if tokens < self.min_cache_tokens:
+            raise errors.ClientError(400, {"error": {
+                "code": 400, "status": "INVALID_ARGUMENT",
+                "message": f"Cached content is too small. total_token_count={tokens}, "
+                           f"min_total_token_count={self.min_cache_tokens}",
+            }})
+        with self.lock:
+            name = f"cachedContents/fake-{len(self.caches) + 1}"
+            self.caches[name] = (api_key, tokens)
+        return SimpleNamespace(name=name)
+
+    def _prefix_tokens(self, api_key, config):
+        """(prompt tokens, cached tokens) the config's system instruction or cached content adds."""
+        if config is None:
+            return 0, 0
+        if getattr(config, "cached_content", None):
+            owner, tokens = self.caches.get(config.cached_content, (None, 0))
+            if owner != api_key:
+                raise errors.ClientError(403, {"error": {
+                    "code": 403, "status": "PERMISSION_DENIED",
+                    "message": f"CachedContent not found (or permission denied): {config.cached_content}",
+                }})
+            return tokens, tokens
+        if getattr(config, "system_instruction", None):
+            if not self.system_instruction_supported:
+                raise errors.ClientError(400, {"error": {
+                    "code": 400, "status": "INVALID_ARGUMENT",
+                    "message": "Developer instruction is not enabled for this model",
+                }})
+            return count_tokens(config.system_instruction), 0
+        return 0, 0
+
+    def _respond(self, api_key, contents, config):
+        prompt = contents if isinstance(contents, str) else str(contents)
+        prefix_tokens, cached_tokens = self._prefix_tokens(api_key, config)
+        if config is not None and getattr(config, "response_schema", None) is not None:
+            text = self._packed_text(prompt)
+        else:
+            # Templates end with "<label>:\n{input}"; answer with Bangla text of similar length
+            payload = prompt.rsplit(":\n", 1)[-1]
+            with self.lock:
+                echoed = self.random.random() < self.echo_prob
+                if echoed:
+                    self.stats["echoed"] += 1
+            text = payload if echoed else bangla_text(len(payload) * self.output_ratio)
+        with self.lock:
+            truncated = self.random.random() < self.truncate_prob
+            if truncated:
+                self.stats["truncated"] += 1
+            self.stats["input_tokens"] += count_tokens(prompt) + prefix_tokens
+            self.stats["cached_tokens"] += cached_tokens
+        if truncated:
+            text = text[:max(1, len(text) // 10)]
+        return fake_response(prompt, text, config, finish_reason="MAX_TOKENS" if truncated else "STOP",
+                             prefix_tokens=prefix_tokens, cached_tokens=cached_tokens)
+
+    def _packed_text(self, prompt):
+        start, end = prompt.find("["), prompt.rfind("]")
+        try:
+            items = json.loads(prompt[start:end + 1])
+        except ValueError:
+            return "[]"
+        return json.dumps([
+            {"id": item["id"], "translation": bangla_text(len(item["text"]) * self.output_ratio)}
+            for item in items
+        ], ensure_ascii=False)
+
+    # Requests are admitted (and counted against the quotas) on arrival, like the real API:
+    # a request cancelled while in flight, e.g. the losing copy of a hedge, still used quota
+    def generate(self, api_key, contents, config=None):
+        self._admit(api_key)
+        _real_sleep(self._latency(contents))
+        return self._respond(api_key, contents, config)
+
+    async def generate_async(self, api_key, contents, config=None):
+        self._admit(api_key)
+        await _real_async_sleep(self._latency(contents))
+        return self._respond(api_key, contents, config)
+
+
+# ----------------- FAKE CLIENT -----------------
+
+class FakeClient:
+    """Mimics the parts of genai.Client that a.py uses: models, caches and aio.models."""
+
+    def __init__(self, server, api_key):
+        self.api_key = api_key
+        self.models = SimpleNamespace(
+            generate_content=lambda model, contents, config=None: server.generate(api_key, contents, config)
+        )
+
+        async def generate_content_async(model, contents, config=None):
+            return await server.generate_async(api_key, contents, config)
+
+        self.caches = SimpleNamespace(create=lambda model, config: server.create_cache(api_key, config))
+        self.aio = SimpleNamespace(models=SimpleNamespace(generate_content=generate_content_async))
+
+
+# ----------------- HELPERS -----------------
+
+def bangla_text(length):
+    length = max(1, int(length))
+    repeats = length // len(BANGLA_FILLER) + 1
+    return (BANGLA_FILLER * repeats)[:length]
+
+def count_tokens(text):
+    return max(1, len(text) // 4)
+
+def fake_response(prompt, text, config=None, finish_reason="STOP", prefix_tokens=0, cached_tokens=0):
+    usage = SimpleNamespace(
+        prompt_token_count=count_tokens(prompt) + prefix_tokens,
+        candidates_token_count=count_tokens(text),
+        cached_content_token_count=cached_tokens or None,
+        total_token_count=count_tokens(prompt) + prefix_tokens + count_tokens(text),
+    )
+    return SimpleNamespace(
+        text=text,
+        usage_metadata=usage,
+        candidates=[SimpleNamespace(finish_reason=finish_reason)],
+    )
+
+def rate_limit_error(retry_delay, daily_quota=None):
+    """Build the 429 the real API returns, with RetryInfo and (for daily quotas) QuotaFailure."""
+    details = [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{int(retry_delay)}s"}]
+    if daily_quota is not None:
+        details.insert(0, {
+            "@type": "type.googleapis.com/google.rpc.QuotaFailure",
+            "violations": [{
+                "quotaMetric": "generativelanguage.googleapis.com/generate_content_free_tier_requests",
+                "quotaId": "GenerateRequestsPerDayPerProjectPerModel-FreeTier",
+                "quotaValue": str(daily_quota),
+            }],
+        })
+    return errors.ClientError(429, {"error": {
+        "code": 429,
+        "message": "You exceeded your current quota, please check your plan and billing details.",
+        "status": "RESOURCE_EXHAUSTED",
+        "details": details,
+    }})
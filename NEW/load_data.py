@@ -1,13 +1,15 @@
 from datasets import load_dataset
-import pandas as pd
 
 # Load dataset
 ds = load_dataset("Shakil2448868/bangla-songs-synthetic-prompt")
 
 print(ds)  # This will show available splits (e.g., 'train')
 
-# Convert the 'train' split to pandas DataFrame
-df = ds["train"].to_pandas()
+# Save the Arrow data as is; a.py reads this directory directly (memory-mapped, batch by batch),
+# so there is no to_pandas() of the whole split and no CSV to re-parse. The new_song task in
+# tasks.json reads its syn_prompt column directly:
+#   python a.py song_dataset
+ds.save_to_disk("song_dataset")
 
-# Save to CSV
-df.to_csv("song.csv", index=False, encoding='utf-8-sig')
+# Or write a CSV for other tools
+# ds["train"].to_pandas().to_csv("song.csv", index=False, encoding='utf-8-sig')
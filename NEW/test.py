@@ -1,13 +1,24 @@
+import os
 import pandas as pd
 
-# Read your CSV
-df = pd.read_csv("final_song_output.csv")
+# Read the translated output: CSV by default, or the Parquet file a.py --format=parquet
+# writes (just the needed columns, without re-parsing the Bangla text)
+INPUT_FILE = "final_song_output.csv"
+if not os.path.exists(INPUT_FILE) and os.path.exists("final_song_output.parquet"):
+    INPUT_FILE = "final_song_output.parquet"
+OUTPUT_FILE = "final_song_cleaned" + os.path.splitext(INPUT_FILE)[1]
+COLUMNS = ["Writer", "Title", "Song", "new_song"]
 
-# Drop 'syn_prompt', keep only required columns, and rename 'new_song'
-new_df = df.drop(columns=["syn_prompt"])[["Writer", "Title", "Song", "new_song"]].rename(
-    columns={"new_song": "newly_generated_song"}
-)
+if INPUT_FILE.endswith(".parquet"):
+    df = pd.read_parquet(INPUT_FILE, columns=COLUMNS)
+else:
+    df = pd.read_csv(INPUT_FILE)
 
-# Save to CSV
-new_df.to_csv("final_song_cleaned.csv", index=False, encoding="utf-8-sig")
+# Keep only required columns (dropping 'syn_prompt') and rename 'new_song'
+new_df = df[COLUMNS].rename(columns={"new_song": "newly_generated_song"})
 
+# Save in the same format for upload.py (Dataset.from_parquet for Parquet)
+if OUTPUT_FILE.endswith(".parquet"):
+    new_df.to_parquet(OUTPUT_FILE, index=False)
+else:
+    new_df.to_csv(OUTPUT_FILE, index=False, encoding="utf-8-sig")
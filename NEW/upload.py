@@ -6,7 +6,9 @@ import os
 # -------------------------
 # 1. Config
 # -------------------------
-CSV_FILE = "final_song_cleaned.csv"  # your local CSV file
+DATA_FILE = "final_song_cleaned.csv"  # your local CSV (or Parquet) file
+if not os.path.exists(DATA_FILE) and os.path.exists("final_song_cleaned.parquet"):
+    DATA_FILE = "final_song_cleaned.parquet"
 HF_DATASET_NAME = "Shakil2448868/Bangla-synthetic-song-generation"  # Change to your HF repo name
 HF_TOKEN = os.getenv("HF_TOKEN")  # or put your token here directly
 
@@ -18,20 +20,27 @@ if not HF_TOKEN:
 login(token=HF_TOKEN)
 
 # -------------------------
-# 3. Load and clean CSV
+# 3. Load as HF Dataset
 # -------------------------
-df = pd.read_csv(CSV_FILE)
+if DATA_FILE.endswith(".parquet"):
+    # Arrow reads the columns directly and memory-maps them; no pandas round trip
+    dataset = Dataset.from_parquet(DATA_FILE)
 
-# Keep only desired columns
-# df = df[["text", "trans_bangla"]]
+    # Keep only desired columns
+    # dataset = dataset.select_columns(["text", "trans_bangla"])
+else:
+    df = pd.read_csv(DATA_FILE)
 
-# Reset index
-df.reset_index(drop=True, inplace=True)
+    # Keep only desired columns
+    # df = df[["text", "trans_bangla"]]
 
-# -------------------------
-# 4. Convert to HF Dataset
-# -------------------------
-dataset = Dataset.from_pandas(df)
+    # Reset index
+    df.reset_index(drop=True, inplace=True)
+
+    # -------------------------
+    # 4. Convert to HF Dataset
+    # -------------------------
+    dataset = Dataset.from_pandas(df)
 
 # -------------------------
 # 5. Push to Hugging Face Hub
@@ -7,4 +7,9 @@ tail -f app.log
 
 
 ps aux | grep your_script.py
-kill 12345
\ No newline at end of file
+kill 12345
+# Several workers sharing one input file through leased row ranges
+nohup python3 a.py --worker=w1 medical_data.csv > w1.log 2>&1 &
+nohup python3 a.py --worker=w2 medical_data.csv > w2.log 2>&1 &
+# Quiet long runs: one status line per flush, details in metrics.prom and metrics_events.jsonl
+nohup python3 a.py --quiet final_output.csv > app.log 2>&1 &